@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+'''
+Git backends used by the core search functionality.
+
+Two backends are available, selected by ``config.GIT_BACKEND``:
+
+subprocess
+    Runs every git operation in a new ``git`` subprocess.
+
+batch
+    Keeps a pool of long-lived ``git cat-file --batch-check`` and
+    ``git cat-file --batch`` workers that are reused across queries to resolve
+    revisions and read objects, and reads refs directly from the git directory,
+    keeping them until the refs change. Operations that have no batch equivalent, such as containment queries, fall
+    back to a subprocess.
+
+Both backends provide the same interface:
+
+run(args, stdin=None)
+    Runs ``git`` with the given arguments (and optional standard input) and
+    returns the ``util.cmd_run`` result dictionary.
+
+lines(args)
+    Runs ``git`` with the given arguments and yields the lines of its output
+    as they are written; see ``util.cmd_lines``.
+
+resolve(rev)
+    Returns the full commit sha the revision names, or None.
+
+ref_tips(prefix)
+    Returns a dictionary mapping each ref under the prefix to the commit it
+    points to, peeling annotated tags.
+'''
+
+# Import Python libs
+import atexit
+import os
+import queue
+import subprocess
+import threading
+
+# Import version_check libs
+import version_check.config as config
+import version_check.metrics as metrics
+import version_check.util as util
+
+_LOCK = threading.Lock()
+_BACKENDS = {}
+
+
+def get():
+    '''
+    Returns the backend selected by ``config.GIT_BACKEND`` for the repository
+    at ``config.GIT_DIR``. Backends are created once and reused.
+    '''
+    key = (config.GIT_BACKEND, config.GIT_DIR)
+    with _LOCK:
+        if key not in _BACKENDS:
+            if config.GIT_BACKEND == 'batch':
+                _BACKENDS[key] = BatchBackend(config.GIT_DIR)
+            else:
+                _BACKENDS[key] = SubprocessBackend(config.GIT_DIR)
+        return _BACKENDS[key]
+
+
+def close_all():
+    '''
+    Closes all backends, stopping any long-lived git workers.
+    '''
+    with _LOCK:
+        backends = list(_BACKENDS.values())
+        _BACKENDS.clear()
+    for git_backend in backends:
+        git_backend.close()
+
+
+def refs_stamp(git_dir):
+    '''
+    Returns a value that changes whenever a fetch or ``git pack-refs`` updates
+    the refs of the given repository. This only stats files, so it is cheap
+    enough to check on every query, and it notices updates made by other
+    processes.
+
+    git_dir
+        The ``--git-dir`` argument, such as ``config.GIT_DIR``.
+    '''
+    path = git_dir_path(git_dir)
+    stamp = []
+    for name in ('FETCH_HEAD', 'packed-refs'):
+        try:
+            stat = os.stat(os.path.join(path, name))
+        except OSError:
+            stamp.append(None)
+            continue
+        stamp.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(stamp)
+
+
+def git_dir_path(git_dir):
+    '''
+    Returns the filesystem path of the git directory given as a
+    ``--git-dir=PATH`` argument.
+
+    git_dir
+        The ``--git-dir`` argument, such as ``config.GIT_DIR``.
+    '''
+    return git_dir.split('=', 1)[1] if git_dir.startswith('--git-dir=') else git_dir
+
+
+class SubprocessBackend(object):
+    '''
+    Backend that runs each git operation in its own subprocess.
+    '''
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+
+    def run(self, args, stdin=None):
+        return util.cmd_run(['git', self.git_dir] + list(args), stdin=stdin)
+
+    def lines(self, args):
+        return util.cmd_lines(['git', self.git_dir] + list(args))
+
+    def resolve(self, rev):
+        cmd_ret = self.run(['rev-parse', '--verify', '--quiet', '{0}^{{commit}}'.format(rev)])
+        if cmd_ret['retcode'] != 0:
+            return None
+        return cmd_ret['stdout'].decode().strip()
+
+    def ref_tips(self, prefix):
+        cmd_ret = self.run(['for-each-ref', '--format=%(objectname) %(*objectname) %(refname)', prefix])
+        if cmd_ret['retcode'] != 0:
+            return {}
+
+        tips = {}
+        for line in cmd_ret['stdout'].decode().splitlines():
+            sha, peeled, ref = line.split(' ', 2)
+            tips[ref] = peeled or sha
+        return tips
+
+    def close(self):
+        pass
+
+
+class BatchBackend(SubprocessBackend):
+    '''
+    Backend that reuses long-lived ``git cat-file`` workers and reads refs
+    in-process.
+    '''
+
+    def __init__(self, git_dir):
+        super(BatchBackend, self).__init__(git_dir)
+        self.path = git_dir_path(git_dir)
+        self._check = _WorkerPool(git_dir, '--batch-check', config.GIT_BATCH_WORKERS)
+        self._batch = _WorkerPool(git_dir, '--batch', config.GIT_BATCH_WORKERS)
+        # Ref tips by prefix, with the stamp of the refs they were read from
+        self._tips = {}
+
+    def resolve(self, rev):
+        rev = str(rev)
+        if not rev or '\n' in rev:
+            return None
+        header, _ = self._check.query('{0}^{{commit}}'.format(rev))
+        parts = header.split()
+        if len(parts) != 3 or parts[1] != 'commit':
+            return None
+        return parts[0]
+
+    def read_object(self, sha):
+        '''
+        Returns a tuple of the type and raw contents of the given object, or
+        ``(None, None)`` if the object does not exist.
+        '''
+        header, body = self._batch.query(sha)
+        parts = header.split()
+        if len(parts) != 3:
+            return None, None
+        return parts[1], body
+
+    def ref_tips(self, prefix):
+        if os.path.isdir(os.path.join(self.path, 'reftable')):
+            # Only the files ref storage format can be read in-process
+            return super(BatchBackend, self).ref_tips(prefix)
+
+        # The stamp is taken before reading, so that refs that change while
+        # they are read are read again by the next call
+        stamp = self._refs_stamp(prefix)
+        cached = self._tips.get(prefix)
+        if cached is not None and cached[0] == stamp:
+            return dict(cached[1])
+
+        # Read the loose refs before the packed ones, as git does: a ref that
+        # ``git pack-refs`` moves in between is then found in one or the other
+        loose = self._read_loose_refs(prefix)
+        refs = {}
+        peeled = {}
+        self._read_packed_refs(prefix, refs, peeled)
+        for ref, value in loose.items():
+            refs[ref] = value
+            peeled.pop(ref, None)
+
+        tips = {}
+        for ref, sha in refs.items():
+            if sha.startswith('ref: '):
+                target = sha[len('ref: '):]
+                if target not in refs or refs[target].startswith('ref: '):
+                    continue
+                sha = refs[target]
+                ref_peeled = peeled.get(target)
+            else:
+                ref_peeled = peeled.get(ref)
+            tips[ref] = ref_peeled or self._peel(sha)
+        self._tips[prefix] = (stamp, tips)
+        return dict(tips)
+
+    def close(self):
+        self._check.close()
+        self._batch.close()
+
+    def _peel(self, sha):
+        '''
+        Returns the commit an annotated tag points to. Other objects are
+        returned unchanged.
+        '''
+        while True:
+            obj_type, body = self.read_object(sha)
+            if obj_type != 'tag':
+                return sha
+            # The first line of a tag object is "object <sha>"
+            sha = body.split(b'\n', 1)[0].split()[1].decode()
+
+    def _refs_stamp(self, prefix):
+        '''
+        Returns a value that changes whenever a ref under the prefix is
+        updated, added or removed: the status of ``packed-refs`` and of every
+        loose ref under the prefix. Only the loose refs are listed, which is
+        much cheaper than parsing a ``packed-refs`` file holding every pull
+        request's refs.
+        '''
+        stamp = []
+        for ref, full_path in self._loose_ref_paths(prefix):
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                continue
+            stamp.append((ref, stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        try:
+            stat = os.stat(os.path.join(self.path, 'packed-refs'))
+            stamp.append(('packed-refs', stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            pass
+        return tuple(sorted(stamp))
+
+    def _loose_ref_paths(self, prefix):
+        '''
+        Yields the name and path of each loose ref under the prefix.
+        '''
+        base = prefix if prefix.endswith('/') else os.path.dirname(prefix) + '/'
+        root = os.path.join(self.path, base)
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                ref = base + os.path.relpath(full_path, root).replace(os.sep, '/')
+                if ref.startswith(prefix) and not filename.endswith('.lock'):
+                    yield ref, full_path
+
+    def _read_packed_refs(self, prefix, refs, peeled):
+        '''
+        Reads the refs under the prefix from the ``packed-refs`` file. Peeled
+        values are recorded for refs that have them.
+        '''
+        try:
+            with open(os.path.join(self.path, 'packed-refs'), 'rb') as packed:
+                lines = packed.read().decode().splitlines()
+        except (IOError, OSError):
+            return
+
+        fully_peeled = False
+        last_ref = None
+        for line in lines:
+            if line.startswith('#'):
+                fully_peeled = 'fully-peeled' in line.split()
+                continue
+            if line.startswith('^'):
+                if last_ref is not None:
+                    peeled[last_ref] = line[1:]
+                continue
+            sha, ref = line.split(' ', 1)
+            last_ref = None
+            if ref.startswith(prefix):
+                refs[ref] = sha
+                last_ref = ref
+                if fully_peeled:
+                    # Refs without a peeled line do not point to tags
+                    peeled[ref] = sha
+
+    def _read_loose_refs(self, prefix):
+        '''
+        Returns a dictionary of the values of the loose refs under the prefix,
+        keyed by ref name.
+        '''
+        refs = {}
+        for ref, full_path in self._loose_ref_paths(prefix):
+            try:
+                with open(full_path, 'rb') as loose:
+                    value = loose.read().decode().strip()
+            except (IOError, OSError, UnicodeDecodeError):
+                continue
+            refs[ref] = value
+        return refs
+
+
+class _WorkerPool(object):
+    '''
+    A thread-safe pool of long-lived ``git cat-file`` workers.
+    '''
+
+    def __init__(self, git_dir, mode, size):
+        self.git_dir = git_dir
+        self.mode = mode
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def query(self, line):
+        # Queries are quick, but do not start one past the deadline
+        util.remaining_time()
+        worker = self._acquire()
+        try:
+            return worker.query(line)
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        with self._lock:
+            workers = self._workers
+            self._workers = []
+        for worker in workers:
+            worker.close()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._workers) < self.size:
+                worker = _CatFileWorker(self.git_dir, self.mode)
+                self._workers.append(worker)
+                return worker
+        return self._idle.get()
+
+
+class _CatFileWorker(object):
+    '''
+    A single long-lived ``git cat-file`` process. Restarted automatically if
+    it exits.
+    '''
+
+    def __init__(self, git_dir, mode):
+        self.git_dir = git_dir
+        self.mode = mode
+        self.proc = None
+
+    def query(self, line):
+        for attempt in range(2):
+            if self.proc is None or self.proc.poll() is not None:
+                self._start()
+            try:
+                self.proc.stdin.write(line.encode() + b'\n')
+                self.proc.stdin.flush()
+                header = self.proc.stdout.readline().decode().strip()
+                if not header:
+                    raise IOError('git cat-file exited unexpectedly')
+                body = None
+                parts = header.split()
+                if self.mode == '--batch' and len(parts) == 3 and parts[1] != 'missing':
+                    # Object contents are followed by a newline
+                    body = self.proc.stdout.read(int(parts[2]) + 1)[:-1]
+                    metrics.inc('version_check_subprocess_bytes_read_total', len(body),
+                                command='git cat-file')
+                return header, body
+            except (IOError, OSError, ValueError):
+                self.close()
+                if attempt:
+                    raise
+        return '', None
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except (IOError, OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+        self.proc = None
+
+    def _start(self):
+        metrics.inc('version_check_subprocesses_total', command='git cat-file')
+        self.proc = subprocess.Popen(
+            ['git', self.git_dir, 'cat-file', self.mode],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+
+
+def _reset_after_fork():
+    '''
+    Forget the parent's backends in a forked child; their workers' pipes
+    belong to the parent.
+    '''
+    global _LOCK
+    _LOCK = threading.Lock()
+    _BACKENDS.clear()
+
+
+atexit.register(close_all)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
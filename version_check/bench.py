@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark suite for the core search functionality.
+
+Generates synthetic repositories of several shapes (see
+``version_check.synthetic``), then times ``core.search``, ``core.get_sha``,
+``core.get_branch_matches`` and ``core.get_tag_matches`` against each of them,
+reporting p50 and p95 latencies and the number of subprocesses started per
+call. No network access is needed.
+
+Results can be saved as a baseline, and later runs compared against it; a run
+fails if an operation's p95 latency grows by more than the tolerance, or if it
+starts more subprocesses than it used to. Latencies depend on the machine, so
+the baseline in the repository, recorded with ``--counts-only``, only holds
+subprocess counts; record a baseline with latencies on the machine it is
+compared on, and keep it out of the repository.
+
+Usage:
+
+.. code-block:: bash
+
+    python -m version_check.bench
+    python -m version_check.bench --shape medium --iterations 100
+    python -m version_check.bench --update-baseline --baseline local-baseline.json
+    python -m version_check.bench --update-baseline --counts-only
+    python -m version_check.bench --set DAG_ENGINE=false --set CACHE_PATH=null
+'''
+
+# Import Python libs
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Import version_check libs
+import version_check.backend as backend
+import version_check.config as config
+import version_check.core as core
+import version_check.synthetic as synthetic
+
+SHAPES = {
+    'small': {'depth': 500, 'release_lines': 3, 'tags_per_line': 5, 'pull_requests': 100},
+    'medium': {'depth': 5000, 'release_lines': 8, 'tags_per_line': 10, 'pull_requests': 1500},
+    'wide-tags': {'depth': 2000, 'release_lines': 20, 'tags_per_line': 25, 'pull_requests': 500},
+}
+
+OPERATIONS = ['get_sha', 'get_branch_matches', 'get_tag_matches', 'search']
+
+DEFAULT_BASELINE = os.path.join('benchmarks', 'baseline.json')
+
+# Latency differences below this many seconds are treated as noise
+_NOISE = 0.002
+
+# Operations timed fewer times than this only have their subprocesses compared
+_MIN_CALLS = 5
+
+
+class _CountingPopen(subprocess.Popen):
+    '''
+    ``subprocess.Popen`` that counts the processes it starts.
+    '''
+    count = 0
+
+    def __init__(self, *args, **kwargs):
+        _CountingPopen.count += 1
+        super(_CountingPopen, self).__init__(*args, **kwargs)
+
+
+def main():
+    '''
+    Run the benchmarks and compare them against, or save them as, the
+    baseline. Exits non-zero if a regression was found.
+    '''
+    args = parse_args()
+    for setting in args.set or []:
+        key, _, value = setting.partition('=')
+        setattr(config, key, json.loads(value))
+
+    results = {}
+    for shape in args.shape or sorted(SHAPES):
+        results[shape] = run_shape(shape, args.iterations, keep=args.keep)
+
+    print_results(results)
+
+    if args.update_baseline:
+        if args.counts_only:
+            results = dict((shape, dict((operation, _counts(result)) for operation, result in operations.items()))
+                           for shape, operations in results.items())
+        baseline_dir = os.path.dirname(args.baseline)
+        if baseline_dir and not os.path.exists(baseline_dir):
+            os.makedirs(baseline_dir)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        print('Baseline written to {0}'.format(args.baseline))
+        return
+
+    if not os.path.exists(args.baseline):
+        print('No baseline found at {0}; run with --update-baseline to create one.'.format(args.baseline))
+        return
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION: ' + regression)
+    if regressions:
+        sys.exit(1)
+    print('No regressions against {0}.'.format(args.baseline))
+
+
+def run_shape(shape, iterations, keep=False):
+    '''
+    Generates a repository of the given shape and times each operation
+    against it. Returns a dictionary of results keyed by operation.
+
+    shape
+        The name of the shape in ``SHAPES``.
+
+    iterations
+        The number of calls to time per operation.
+
+    keep
+        Keep the generated repository and caches instead of removing them.
+    '''
+    workdir = tempfile.mkdtemp(prefix='version-check-bench-')
+    saved = dict((key, getattr(config, key))
+                 for key in ('GIT_DIR', 'REMOTE', 'CACHE_PATH', 'DAG_SNAPSHOT_PATH', 'PATCH_INDEX_PATH'))
+    try:
+        repo = synthetic.make_repo(workdir, **SHAPES[shape])
+        config.GIT_DIR = repo['git_dir']
+        config.REMOTE = 'origin'
+        if config.CACHE_PATH:
+            config.CACHE_PATH = os.path.join(workdir, 'cache.db')
+        config.DAG_SNAPSHOT_PATH = os.path.join(workdir, 'dag-{repo}.snapshot')
+        config.PATCH_INDEX_PATH = os.path.join(workdir, 'patchids.db')
+
+        results = {'fetch': _time_calls(core.fetch_remote, [()])}
+
+        # Use different pull requests for each operation so that one
+        # operation does not warm the caches for the next
+        pull_requests = [str(pr_num) for pr_num in repo['pull_requests']]
+        random.Random(0).shuffle(pull_requests)
+        per_operation = max(1, min(iterations, len(pull_requests) // len(OPERATIONS)))
+        for index, operation in enumerate(OPERATIONS):
+            sample = pull_requests[index * per_operation:(index + 1) * per_operation]
+            if operation == 'get_sha':
+                calls = [(pr_num,) for pr_num in sample]
+                func = core.get_sha
+            elif operation == 'search':
+                calls = [(pr_num,) for pr_num in sample]
+                func = lambda pr_num: core.search(pr_num=pr_num)
+            else:
+                calls = [(core.get_sha(pr_num),) for pr_num in sample]
+                func = getattr(core, operation)
+            results[operation] = _time_calls(func, calls)
+        return results
+    finally:
+        backend.close_all()
+        for key, value in saved.items():
+            setattr(config, key, value)
+        if keep:
+            print('Kept {0} repository in {1}'.format(shape, workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns a list of descriptions of the operations that regressed relative
+    to the baseline.
+
+    results
+        The results of this run, keyed by shape and operation.
+
+    baseline
+        The baseline results, in the same format.
+
+    tolerance
+        The allowed relative growth of p95 latency, e.g. ``0.5`` for 50%.
+    '''
+    regressions = []
+    for shape, operations in sorted(results.items()):
+        for operation, result in sorted(operations.items()):
+            base = baseline.get(shape, {}).get(operation)
+            if base is None:
+                continue
+            # Baselines recorded with --counts-only have no latencies
+            limit = max(base['p95'] * (1 + tolerance), base['p95'] + _NOISE) if 'p95' in base else None
+            if limit is not None and result['calls'] >= _MIN_CALLS and result['p95'] > limit:
+                regressions.append('{0} {1}: p95 {2:.1f}ms, baseline {3:.1f}ms'.format(
+                    shape, operation, result['p95'] * 1000, base['p95'] * 1000))
+            if result['subprocesses'] > base['subprocesses'] + 0.5:
+                regressions.append('{0} {1}: {2:.1f} subprocesses per call, baseline {3:.1f}'.format(
+                    shape, operation, result['subprocesses'], base['subprocesses']))
+    return regressions
+
+
+def _counts(result):
+    '''
+    Returns the parts of an operation's result that do not depend on the
+    machine it ran on.
+    '''
+    return {'calls': result['calls'], 'subprocesses': result['subprocesses']}
+
+
+def print_results(results):
+    '''
+    Print the results as a table.
+    '''
+    print('{0:<10} {1:<20} {2:>6} {3:>10} {4:>10} {5:>8}'.format(
+        'shape', 'operation', 'calls', 'p50 (ms)', 'p95 (ms)', 'procs'))
+    for shape, operations in sorted(results.items()):
+        for operation in ['fetch'] + OPERATIONS:
+            result = operations[operation]
+            print('{0:<10} {1:<20} {2:>6} {3:>10.2f} {4:>10.2f} {5:>8.1f}'.format(
+                shape, operation, result['calls'], result['p50'] * 1000, result['p95'] * 1000,
+                result['subprocesses']))
+
+
+def _time_calls(func, calls):
+    '''
+    Calls the function with each set of arguments and returns the number of
+    calls, the p50 and p95 latencies in seconds, and the mean number of
+    subprocesses started per call.
+    '''
+    durations = []
+    popen = subprocess.Popen
+    subprocess.Popen = _CountingPopen
+    _CountingPopen.count = 0
+    try:
+        for args in calls:
+            start = time.perf_counter()
+            func(*args)
+            durations.append(time.perf_counter() - start)
+    finally:
+        subprocess.Popen = popen
+
+    return {'calls': len(durations),
+            'p50': percentile(durations, 50),
+            'p95': percentile(durations, 95),
+            'subprocesses': float(_CountingPopen.count) / max(1, len(durations))}
+
+
+def percentile(values, percent):
+    '''
+    Returns the nearest-rank percentile of the values.
+    '''
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def parse_args():
+    '''
+    Parse the benchmark options.
+    '''
+    parser = argparse.ArgumentParser(description='Benchmark version_check searches on synthetic repositories')
+    parser.add_argument('--shape', action='append', choices=sorted(SHAPES),
+                        help='Repository shape to benchmark. Default: all shapes.')
+    parser.add_argument('--iterations', type=int, default=50, help='Calls to time per operation.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline results file.')
+    parser.add_argument('--update-baseline', action='store_true', help='Save the results as the new baseline.')
+    parser.add_argument('--counts-only', action='store_true',
+                        help='With --update-baseline, save only the subprocess counts, which do not depend on '
+                             'the machine.')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Allowed relative growth of p95 latency before failing. Default: 0.5')
+    parser.add_argument('--set', action='append', metavar='KEY=JSON',
+                        help='Override a config setting for the run, e.g. DAG_ENGINE=false.')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated repositories.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+'''
+Persistent, on-disk cache of containment answers.
+
+Each answer records whether a commit is contained in a single ref, along with
+the commit the ref pointed to when the answer was computed. Taken together, the
+stored ref tips for a commit act as a fingerprint of the ref snapshot the
+answers belong to. When a fetch moves some refs, only the answers for those
+refs go stale and need to be re-evaluated; the rest of the cached answers for
+the commit remain valid.
+
+The cache is bounded by the number of commits it holds. When that bound is
+exceeded, the least recently used commits are evicted.
+'''
+
+# Import Python libs
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Import version_check libs
+import version_check.config as config
+
+LOG = logging.getLogger(__name__)
+
+_LOCAL = threading.local()
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS commits (
+    repo TEXT NOT NULL,
+    commit_sha TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (repo, commit_sha)
+);
+CREATE INDEX IF NOT EXISTS commits_last_used ON commits (last_used);
+CREATE TABLE IF NOT EXISTS containment (
+    repo TEXT NOT NULL,
+    commit_sha TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    tip TEXT NOT NULL,
+    contained INTEGER NOT NULL,
+    PRIMARY KEY (repo, commit_sha, kind, ref)
+);
+'''
+
+
+def lookup(commit, kind, tips):
+    '''
+    Returns a tuple of the set of refs known to contain the given commit, and
+    the list of refs that have no valid cached answer and must be evaluated.
+
+    commit
+        The full commit sha to look up.
+
+    kind
+        The kind of ref being searched: ``branch`` or ``tag``.
+
+    tips
+        A dictionary mapping each ref name to the commit it currently
+        points to.
+    '''
+    conn = connect(config.CACHE_PATH, _SCHEMA)
+    if conn is None:
+        return set(), sorted(tips)
+
+    try:
+        with conn:
+            rows = conn.execute(
+                'SELECT ref, tip, contained FROM containment '
+                'WHERE repo = ? AND commit_sha = ? AND kind = ?',
+                (config.GIT_DIR, commit, kind)
+            ).fetchall()
+            if rows:
+                _touch(conn, commit)
+    except sqlite3.Error as exc:
+        LOG.warning('Containment cache lookup failed: %s', exc)
+        return set(), sorted(tips)
+
+    matches = set()
+    fresh = set()
+    for ref, tip, contained in rows:
+        if tips.get(ref) != tip:
+            # The ref moved (or was deleted) since this answer was stored
+            continue
+        fresh.add(ref)
+        if contained:
+            matches.add(ref)
+
+    stale = sorted(ref for ref in tips if ref not in fresh)
+    return matches, stale
+
+
+def store(commit, kind, tips, matches):
+    '''
+    Stores containment answers for the given commit.
+
+    commit
+        The full commit sha the answers belong to.
+
+    kind
+        The kind of ref that was searched: ``branch`` or ``tag``.
+
+    tips
+        A dictionary mapping each evaluated ref name to the commit it pointed
+        to when it was evaluated.
+
+    matches
+        The set of evaluated refs that contain the commit.
+    '''
+    conn = connect(config.CACHE_PATH, _SCHEMA)
+    if conn is None or not tips:
+        return
+
+    rows = [(config.GIT_DIR, commit, kind, ref, tip, int(ref in matches))
+            for ref, tip in tips.items()]
+    try:
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO containment '
+                '(repo, commit_sha, kind, ref, tip, contained) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            _touch(conn, commit)
+            _evict(conn)
+    except sqlite3.Error as exc:
+        LOG.warning('Containment cache store failed: %s', exc)
+
+
+def _touch(conn, commit):
+    '''
+    Marks the given commit as recently used.
+    '''
+    conn.execute(
+        'INSERT OR REPLACE INTO commits (repo, commit_sha, last_used) '
+        'VALUES (?, ?, ?)',
+        (config.GIT_DIR, commit, time.time())
+    )
+
+
+def _evict(conn):
+    '''
+    Evicts the least recently used commits once the cache grows beyond
+    ``config.CACHE_MAX_COMMITS``.
+    '''
+    count = conn.execute('SELECT COUNT(*) FROM commits').fetchone()[0]
+    excess = count - config.CACHE_MAX_COMMITS
+    if excess <= 0:
+        return
+
+    victims = conn.execute(
+        'SELECT repo, commit_sha FROM commits ORDER BY last_used LIMIT ?',
+        (excess,)
+    ).fetchall()
+    conn.executemany(
+        'DELETE FROM containment WHERE repo = ? AND commit_sha = ?', victims
+    )
+    conn.executemany(
+        'DELETE FROM commits WHERE repo = ? AND commit_sha = ?', victims
+    )
+
+
+def connect(path, schema):
+    '''
+    Returns this thread's connection to the SQLite database at the given
+    path, creating the database and its schema if necessary. Returns None if
+    the path is not set or the database cannot be opened.
+
+    path
+        The path of the database file.
+
+    schema
+        The SQL script that creates the database's tables.
+    '''
+    if not path:
+        return None
+
+    conns = getattr(_LOCAL, 'conns', None)
+    if conns is None:
+        conns = _LOCAL.conns = {}
+    if path in conns:
+        return conns[path]
+
+    conn = None
+    try:
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, mode=0o700)
+        conn = sqlite3.connect(path, timeout=30)
+        conn.executescript(schema)
+    except (OSError, sqlite3.Error) as exc:
+        LOG.warning('Unable to open database %s: %s', path, exc)
+        conn = None
+
+    conns[path] = conn
+    return conn
+
+
+def _reset_after_fork():
+    '''
+    Drop the parent's connections in a forked child; SQLite connections must
+    not be shared across processes.
+    '''
+    global _LOCAL
+    _LOCAL = threading.local()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -21,10 +21,17 @@ on the script's functionality in tandem with the Dockerfile.
 
 # Import Python libs
 import argparse
+import concurrent.futures
+import json
+import sys
 
 # Import version_check libs
 import version_check.config as config
 import version_check.core as core
+import version_check.daemon as daemon
+import version_check.fetcher as fetcher
+import version_check.maintenance as maintenance
+import version_check.metrics as metrics
 
 
 def main():
@@ -35,16 +42,85 @@ def main():
     '''
     # Parse args and define some basic params
     args = parse_args()
+    try:
+        run(args)
+    finally:
+        if args.profile:
+            print_profile()
+
+
+def run(args):
+    '''
+    Run the command, or the search, selected by the parsed CLI options.
+
+    args
+        The parsed CLI options.
+    '''
+    if args.command == 'maintain':
+        maintain()
+        return
+
+    if args.command == 'setup':
+        setup()
+        return
+
+    if args.serve:
+        ret = daemon.serve()
+        if ret.get('error'):
+            print(ret['error'])
+        return
+
+    if args.batch:
+        search_batch(args)
+        return
+
+    if args.list_prs:
+        list_prs(args)
+        return
+
     commit = args.commit
     pr_num = args.pull_request
 
-    ret = core.search(
-        pr_num=pr_num,
-        commit=commit,
-        fetch=not args.skip_fetch,
-        branch_limiters=args.branch,
-        tag_limiters=args.tag
-    )
+    search_kwargs = {'pr_num': pr_num,
+                     'commit': commit,
+                     'fetch': not args.skip_fetch,
+                     'branch_limiters': args.branch,
+                     'tag_limiters': args.tag,
+                     'max_age': args.max_age,
+                     'equivalent': args.equivalent,
+                     'repos': args.repo,
+                     'timeout': args.timeout}
+
+    # Use the warm daemon when one is running, unless profiling this process
+    ret = None
+    if not args.profile:
+        ret = daemon.search(search_kwargs)
+    if ret is None:
+        ret = core.search(**search_kwargs)
+    if 'repos' in ret:
+        for index, name in enumerate(args.repo):
+            if index:
+                print('')
+            print('Repository: {0}'.format(name))
+            print_result(ret['repos'][name], pr_num, commit)
+        return
+
+    print_result(ret, pr_num, commit)
+
+
+def print_result(ret, pr_num, commit):
+    '''
+    Print the result of a search of a single repository.
+
+    ret
+        The search result.
+
+    pr_num
+        The pull request number searched for, if any.
+
+    commit
+        The commit searched for, if any.
+    '''
     if ret.get('error'):
         print(ret.get('error'))
         return
@@ -63,25 +139,215 @@ def main():
         print('Tags:')
         for tag in tags:
             print('  ' + tag)
+    first_tags = ret.get('first_tags')
+    if first_tags:
+        print('First Released In:')
+        for tag in sorted(first_tags.values(), key=lambda tag: core.parse_tag(tag)[1]):
+            print('  ' + tag)
+    equivalent = ret.get('equivalent')
+    if equivalent and equivalent['commits']:
+        found = True
+        print('Equivalent Commits:')
+        for equivalent_commit in equivalent['commits']:
+            print('  ' + equivalent_commit)
+        for title, key in (('Branches', 'branches'), ('Tags', 'tags')):
+            if equivalent.get(key):
+                print('{0} (via equivalent commits):'.format(title))
+                for ref in equivalent[key]:
+                    print('  ' + ref)
     if found is False:
         comment = 'The {0} \'{1}\' was not found.'.format('pull request' if pr_num else 'commit',
                                                           pr_num if pr_num else commit)
         print(comment)
 
 
+def maintain():
+    '''
+    Run repository maintenance, update the reachability snapshot and patch-id
+    index, and print the steps taken and the timings of a sample query before
+    and after.
+    '''
+    ret = maintenance.maintain()
+    if config.DAG_ENGINE:
+        core.update_dag()
+    if config.PATCH_INDEX:
+        core.update_patch_index()
+    for step in ret['steps']:
+        print('{0} ({1})'.format(step['command'], 'ok' if step['retcode'] == 0 else 'failed'))
+    if 'before' in ret:
+        print('Sample query: {0:.3f}s before, {1:.3f}s after'.format(ret['before'], ret['after']))
+
+
+def setup():
+    '''
+    Clone the repository at ``GIT_DIR`` from ``REMOTE_URL``, if it does not
+    exist yet, and fetch the refs searches need.
+    '''
+    for step, func in (('Cloned', fetcher.clone), ('Fetched', core.fetch_remote)):
+        cmd_ret = func()
+        if cmd_ret is None:
+            continue
+        if cmd_ret['retcode'] != 0:
+            output = cmd_ret['stdout']
+            if isinstance(output, bytes):
+                output = output.decode(errors='replace')
+            print('ERROR: {0}'.format(output.strip()))
+            sys.exit(1)
+        print('{0} {1}'.format(step, config.REMOTE_URL))
+
+
+def list_prs(args):
+    '''
+    Print the pull requests merged in the range given with ``--list-prs``,
+    newest first, as they are found.
+
+    args
+        The parsed CLI options.
+    '''
+    found = []
+
+    def _print_pr(pull_request):
+        if not found:
+            print('Pull Requests:')
+        found.append(pull_request)
+        print('  #{0} ({1})'.format(pull_request['number'], pull_request['commit']), flush=True)
+
+    ret = core.list_prs(args.list_prs,
+                        fetch=not args.skip_fetch,
+                        max_age=args.max_age,
+                        timeout=args.timeout,
+                        callback=_print_pr)
+    if ret.get('error'):
+        print(ret['error'])
+    elif not found:
+        print('No pull requests were found in \'{0}\'.'.format(args.list_prs))
+
+
+def search_batch(args):
+    '''
+    Search for every pull request number or commit hash listed in the batch
+    input, one per line.
+
+    The fetch is performed once up front, and the searches then share the
+    same git backend and caches. Results are printed as JSON Lines, one per
+    distinct search item, as soon as each search completes.
+
+    args
+        The parsed CLI options.
+    '''
+    if not args.skip_fetch:
+        with metrics.timer('fetch'):
+            if args.repo:
+                core.fetch_repos(args.repo, max_age=args.max_age)
+            else:
+                core.fetch_remote(max_age=args.max_age)
+
+    batch_input = sys.stdin if args.batch == '-' else open(args.batch)
+    pending = {}
+    seen = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.SEARCH_CONCURRENCY) as executor:
+        with batch_input:
+            for line in batch_input:
+                item = line.strip()
+                if not item or item in seen:
+                    continue
+                seen.add(item)
+                if item.lstrip('#').isdigit():
+                    search_kwargs = {'pr_num': item}
+                else:
+                    search_kwargs = {'commit': item}
+                search_kwargs['branch_limiters'] = args.branch
+                search_kwargs['tag_limiters'] = args.tag
+                search_kwargs['equivalent'] = args.equivalent
+                search_kwargs['repos'] = args.repo
+                search_kwargs['timeout'] = args.timeout
+                future = executor.submit(core.search, **search_kwargs)
+                pending[future] = search_kwargs
+
+                # Stream out anything that has already finished
+                for future in [future for future in pending if future.done()]:
+                    _print_batch_result(pending.pop(future), future.result())
+
+        for future in concurrent.futures.as_completed(list(pending)):
+            _print_batch_result(pending.pop(future), future.result())
+
+
+def _print_batch_result(search_kwargs, ret):
+    '''
+    Print a single batch search result as a line of JSON.
+    '''
+    if 'pr_num' in search_kwargs:
+        result = {'pull_request': search_kwargs['pr_num'].lstrip('#')}
+    else:
+        result = {'commit': search_kwargs['commit']}
+    if ret.get('error'):
+        result['error'] = str(ret['error'])
+    else:
+        result.update(ret)
+    print(json.dumps(result), flush=True)
+
+
+def print_profile():
+    '''
+    Print the time spent in each phase, the subprocesses started and the
+    sources of containment answers to stderr.
+    '''
+    values, histograms = metrics.snapshot()
+    lines = ['Profile:', '  {0:<20} {1:>6} {2:>10}'.format('phase', 'calls', 'seconds')]
+    phases = sorted(
+        (dict(labels)['phase'], count, total)
+        for (name, labels), (_, total, count) in histograms.items()
+        if name == 'version_check_phase_seconds'
+    )
+    for phase, count, total in phases:
+        lines.append('  {0:<20} {1:>6} {2:>10.3f}'.format(phase, count, total))
+
+    for title, name in (('Subprocesses', 'version_check_subprocesses_total'),
+                        ('Bytes read', 'version_check_subprocess_bytes_read_total'),
+                        ('Containment answers', 'version_check_containment_answers_total')):
+        series = sorted((labels, value) for (series_name, labels), value in values.items()
+                        if series_name == name and value)
+        if not series:
+            continue
+        lines.append('{0}: {1}'.format(title, sum(value for _, value in series)))
+        for labels, value in series:
+            lines.append('  {0:<27} {1:>10}'.format(', '.join(label for _, label in labels), value))
+
+    print('\n'.join(lines), file=sys.stderr)
+
+
 def parse_args():
     '''
     Parse the CLI options.
     '''
     # Define parser and set up basic options
     parser = argparse.ArgumentParser(description='Search for pull requests or commits in Salt')
+    parser.add_argument('command', nargs='?', choices=['maintain', 'setup'],
+                        help='"maintain": pack refs and update the commit-graph so searches run faster. '
+                             '"setup": clone the repository from REMOTE_URL and fetch it.')
     parser.add_argument('-v', '--version', action='version', version=config.VERSION, help='Print version and exit.')
     parser.add_argument('--skip-fetch', action='store_true', help='Do not fetch latest from upstream.')
+    parser.add_argument('--max-age', type=int, metavar='SECONDS',
+                        help='Skip the fetch if the refs were updated within this many seconds.')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='Stop a search, and its git commands, after this many seconds.')
+    parser.add_argument('--serve', action='store_true',
+                        help='Run a daemon that keeps the repository and indexes loaded and answers the '
+                             'searches of later version-check runs.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print the time spent in each phase and the git subprocesses run to stderr.')
 
     # Define mutually exclusive group: Can only search for a PR or commit, not both.
-    search_items = parser.add_mutually_exclusive_group(required=True)
+    search_items = parser.add_mutually_exclusive_group()
     search_items.add_argument('-p', '--pull-request', help='Pull request number to search for.')
     search_items.add_argument('-c', '--commit', help='Commit hash to search for.')
+    search_items.add_argument('--batch', metavar='FILE',
+                              help='File listing pull request numbers or commit hashes to search for, '
+                                   'one per line. Use "-" to read from stdin. Results are printed as '
+                                   'JSON Lines.')
+    search_items.add_argument('--list-prs', metavar='RANGE',
+                              help='List the pull requests merged in a range, such as '
+                                   'v2018.3.2..v2018.3.3, or in a branch or tag.')
 
     # Set up search specifications
     search_specs = parser.add_argument_group(title='search specifications',
@@ -89,8 +355,19 @@ def parse_args():
                                                          'Default searches all tags and branches.')
     search_specs.add_argument('-b', '--branch', action='append', help='Branch(es) to search specifically.')
     search_specs.add_argument('-t', '--tag', action='append', help='Release tag(s) to search specifically.')
+    search_specs.add_argument('-r', '--repo', action='append', choices=sorted(config.REPOS),
+                              help='Configured repository(ies) to search, all at once. '
+                                   'Default: the repository at GIT_DIR.')
+    search_specs.add_argument('--equivalent', action='store_true',
+                              help='Also find commits that make the same change, such as cherry-picked '
+                                   'backports. Requires PATCH_INDEX to be enabled.')
+
+    args = parser.parse_args()
+    if args.command is None and not (args.serve or args.pull_request or args.commit or args.batch
+                                      or args.list_prs):
+        parser.error('one of the arguments -p/--pull-request -c/--commit --batch --list-prs is required')
 
-    return parser.parse_args()
+    return args
 
 
 if __name__ == '__main__':
@@ -4,3 +4,111 @@ VERSION = '0.1.0'
 GIT_DIR = '--git-dir=/salt/.git'
 SLACK_APP_PORT = 8888
 REMOTE = 'origin'
+
+# Containment answer cache. Set CACHE_PATH to None to disable the cache.
+CACHE_PATH = '/var/cache/version_check/cache.db'
+CACHE_MAX_COMMITS = 5000
+
+# Where ``version-check setup`` clones the repository at GIT_DIR from.
+REMOTE_URL = 'https://github.com/saltstack/salt.git'
+
+# Refspecs used by ``git fetch``. ``{remote}`` is replaced with REMOTE. To
+# fetch only release branches, list them, e.g.
+# '+refs/heads/20*:refs/remotes/{remote}/20*'.
+FETCH_REFSPECS = ['+refs/heads/*:refs/remotes/{remote}/*']
+
+# Tags are fetched with TAG_REFSPECS. With FETCH_NO_TAGS set, no other tags
+# are fetched along with the branches.
+TAG_REFSPECS = ['+refs/tags/v*:refs/tags/v*']
+FETCH_NO_TAGS = True
+
+# Partial clone filter used by setup and fetches. Searches never read file
+# contents, so 'blob:none' skips downloading them. Set to None for a full
+# clone, which the patch-id index (PATCH_INDEX) needs to read diffs quickly.
+FETCH_FILTER = 'blob:none'
+
+# Pull request refs are fetched into this namespace to build the PR index.
+PR_NAMESPACE = 'refs/version-check/pull'
+PR_INDEX_MERGE_REFS = True
+
+# Git backend: 'batch' keeps long-lived git cat-file workers, 'subprocess'
+# runs a new git process for every operation.
+GIT_BACKEND = 'batch'
+GIT_BATCH_WORKERS = 4
+
+# Maximum number of searches run at once by core.search_async. Set
+# SEARCH_PROCESSES to run them in that many worker processes instead of
+# threads, to use several cores (0 uses threads).
+SEARCH_CONCURRENCY = 4
+SEARCH_PROCESSES = 0
+
+# Unix socket of the search daemon started with ``version-check --serve``.
+# The CLI uses the daemon when it is running.
+DAEMON_SOCKET = '/var/run/version_check/daemon.sock'
+
+# In-memory search result cache used by the Slack App.
+SLACK_RESULT_CACHE_SIZE = 256
+SLACK_RESULT_CACHE_TTL = 300
+
+# The Slack App accepts at most SLACK_QUEUE_SIZE commands needing a search at
+# once and asks users to retry beyond that. Its searches are stopped after
+# SEARCH_TIMEOUT seconds (0 to never stop them).
+SLACK_QUEUE_SIZE = 32
+SEARCH_TIMEOUT = 60
+
+# Posting messages to Slack: at most SLACK_DELIVERY_MAX_CLIENTS posts at once,
+# with connect and request timeouts in seconds. Failed posts are retried up
+# to SLACK_DELIVERY_RETRIES times, waiting SLACK_DELIVERY_BACKOFF seconds
+# before the first retry and twice as long before each following one.
+SLACK_DELIVERY_MAX_CLIENTS = 10
+SLACK_DELIVERY_CONNECT_TIMEOUT = 5
+SLACK_DELIVERY_TIMEOUT = 10
+SLACK_DELIVERY_RETRIES = 3
+SLACK_DELIVERY_BACKOFF = 0.5
+
+# Fetch scheduling. The Slack App fetches every FETCH_INTERVAL seconds (0 to
+# disable), and fetches within FETCH_DEBOUNCE seconds of the last one are
+# skipped.
+FETCH_INTERVAL = 300
+FETCH_DEBOUNCE = 10
+
+# Long-running processes (the Slack App and the search daemon) precompute the
+# containment of the pull requests merged since the previous fetch in the
+# background, so that searches for them are answered from the cache. At most
+# PRECOMPUTE_MAX_COMMITS commits are queued (0 to disable).
+PRECOMPUTE_MAX_COMMITS = 200
+
+# How tags are searched: 'scan' checks every tag, 'bisect' binary searches
+# each release line for the first release containing the commit and reports
+# every later release in the line too. 'bisect' is only correct when each
+# release is an ancestor of the next one in its line, which hotfix and
+# security releases made off to the side may not be.
+TAG_SEARCH = 'scan'
+
+# A search runs its branch search and up to CONTAINMENT_SHARDS shards of
+# release lines of its tag search at the same time, on separate cores. 0 uses
+# one shard per CPU, and 1 searches them one after the other.
+CONTAINMENT_SHARDS = 0
+
+# Repository maintenance (pack refs, update the commit-graph) after fetches.
+MAINTAIN_AFTER_FETCH = True
+MAINTAIN_SAMPLE_DEPTH = 1000
+
+# In-process reachability engine. The snapshot is rebuilt from scratch when
+# more than DAG_REBUILD_THRESHOLD refs changed since it was written.
+DAG_ENGINE = True
+DAG_SNAPSHOT_PATH = '/var/cache/version_check/dag-{repo}.snapshot'
+DAG_REBUILD_THRESHOLD = 64
+
+# Patch-id index used to find equivalent (cherry-picked) commits. Building it
+# diffs the whole history once, so it is off by default.
+PATCH_INDEX = False
+PATCH_INDEX_PATH = '/var/cache/version_check/patchids.db'
+
+# Repositories that can be searched together with ``--repo``, keyed by name.
+# Each sets 'git_dir', and optionally 'remote' (default: REMOTE). Searches of
+# several repositories run in up to REPO_WORKERS worker processes at once.
+REPOS = {
+    'salt': {'git_dir': GIT_DIR, 'remote': REMOTE},
+}
+REPO_WORKERS = 4
@@ -3,16 +3,61 @@
 Core program functionality.
 '''
 
+# Import Python libs
+import concurrent.futures
+import fnmatch
+import functools
+import logging
+import os
+import re
+import threading
+import time
+
 # Import version_check libs
+import version_check.backend as backend
+import version_check.cache as cache
 import version_check.config as config
+import version_check.dag as dag
+import version_check.fetcher as fetcher
+import version_check.maintenance as maintenance
+import version_check.metrics as metrics
+import version_check.oidindex as oidindex
+import version_check.patchindex as patchindex
+import version_check.precompute as precompute
+import version_check.prindex as prindex
 import version_check.util as util
 
+LOG = logging.getLogger(__name__)
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+_REPO_EXECUTOR = None
+_PROCESS_EXECUTOR = None
+_SHARD_EXECUTOR = None
+_SHARD = threading.local()
+
+# Release tags such as v2017.7.2, v2019.2.0rc1, v3000 and v3006.1
+_TAG_RE = re.compile(r'^v(\d+)(?:\.(\d+))?(?:\.(\d+))?(?:rc(\d+))?$')
+
+# Abbreviated commit shas, resolved with the object id index
+_ABBREV_RE = re.compile(r'^[0-9a-fA-F]{{{0},39}}$'.format(oidindex.MIN_LENGTH))
+
+# Candidates listed when an abbreviated sha is ambiguous
+_MAX_CANDIDATES = 10
+
+# Subjects of GitHub merge commits, and of squash merges, naming a pull request
+_MERGE_SUBJECT_RE = re.compile(r'^Merge pull request #(\d+) ')
+_SQUASH_SUBJECT_RE = re.compile(r'\(#(\d+)\)$')
+
 
 def search(pr_num=None,
            commit=None,
            fetch=False,
            branch_limiters=None,
-           tag_limiters=None):
+           tag_limiters=None,
+           max_age=None,
+           equivalent=False,
+           repos=None,
+           timeout=None):
     '''
     Searches for matching branches and tags based on the given PR or commit
     hash. Either a PR or commit must be provided.
@@ -34,12 +79,424 @@ def search(pr_num=None,
     tag_limiters
         The tag or tags to search specifically. Should be passed as a list.
         Defaults to None, which searches all branches.
+
+    max_age
+        When fetching, skip the fetch if the refs were updated within this
+        many seconds. Defaults to None, which always fetches.
+
+    equivalent
+        Also search for commits that make the same change as the commit, such
+        as cherry-picked backports, using the patch-id index. The results are
+        returned under ``equivalent``. Defaults to ``False``.
+
+    repos
+        The names of the repositories in ``config.REPOS`` to search, all at
+        once. The results for each repository are returned under ``repos``,
+        keyed by name. Defaults to None, which searches the repository at
+        ``config.GIT_DIR``.
+
+    timeout
+        Stop the search, killing any git commands it is running, if it takes
+        longer than this many seconds, and return an error. Defaults to None,
+        which lets the search run to completion.
+    '''
+    if repos:
+        return search_repos(repos,
+                            pr_num=pr_num,
+                            commit=commit,
+                            fetch=fetch,
+                            branch_limiters=branch_limiters,
+                            tag_limiters=tag_limiters,
+                            max_age=max_age,
+                            equivalent=equivalent,
+                            timeout=timeout)
+
+    try:
+        with metrics.timer('search'), util.deadline(timeout):
+            return _search(pr_num=pr_num,
+                           commit=commit,
+                           fetch=fetch,
+                           branch_limiters=branch_limiters,
+                           tag_limiters=tag_limiters,
+                           max_age=max_age,
+                           equivalent=equivalent)
+    except util.CommandTimeout:
+        return {'error': 'ERROR: the search took too long and was stopped.'}
+    except util.CommandError as exc:
+        return {'error': 'ERROR: {0}'.format(exc)}
+
+
+def search_repos(repos, **kwargs):
+    '''
+    Runs the same search in each of the given repositories at once and
+    returns the results under ``repos``, keyed by repository name.
+
+    Each repository is searched in its own worker process, from a pool of
+    ``config.REPO_WORKERS`` processes, so the search takes about as long as
+    the slowest repository rather than all of them together.
+
+    repos
+        The names of the repositories in ``config.REPOS`` to search.
+
+    kwargs
+        The arguments of ``search``, other than ``repos``.
+    '''
+    return {'repos': _run_in_repos(repos, search, kwargs)}
+
+
+def fetch_repos(repos, max_age=None):
+    '''
+    Fetches each of the given repositories at once, in the repository worker
+    processes. Returns a dictionary of the ``fetch_remote`` result for each
+    repository, keyed by name.
+
+    repos
+        The names of the repositories in ``config.REPOS`` to fetch.
+
+    max_age
+        Skip the fetch of repositories whose refs were updated within this
+        many seconds. Defaults to None, which always fetches.
+    '''
+    return _run_in_repos(repos, fetch_remote, {'max_age': max_age})
+
+
+def list_prs(rev_range, fetch=False, max_age=None, timeout=None, callback=None):
+    '''
+    Lists the pull requests merged in the given range of history, newest
+    first, in a single pass over its commits. Returns them under
+    ``pull_requests`` as dictionaries of the pull request ``number`` and the
+    ``commit`` that brought it in.
+
+    Pull requests are recognized by the subjects of GitHub's merge commits
+    and squash merges, and by commits that are the head of a pull request in
+    the pull request index.
+
+    rev_range
+        The range to list: ``START..END``, such as ``v2018.3.2..v2018.3.3``,
+        for the pull requests in END but not in START, or a single branch,
+        tag or commit for everything it contains.
+
+    fetch
+        Specify whether or not to perform a ``git fetch`` from upstream.
+        Defaults to ``False``.
+
+    max_age
+        When fetching, skip the fetch if the refs were updated within this
+        many seconds. Defaults to None, which always fetches.
+
+    timeout
+        Stop listing, and return an error, if it takes longer than this many
+        seconds. Defaults to None.
+
+    callback
+        A function called with each pull request's dictionary as soon as it
+        is found, so the pull requests can be shown while the rest of the
+        range is read. Defaults to None.
+    '''
+    try:
+        with metrics.timer('pr_list'), util.deadline(timeout):
+            return _list_prs(rev_range, fetch, max_age, callback)
+    except util.CommandTimeout:
+        return {'error': 'ERROR: the search took too long and was stopped.'}
+
+
+async def search_async(pr_num=None,
+                       commit=None,
+                       fetch=False,
+                       branch_limiters=None,
+                       tag_limiters=None,
+                       max_age=None,
+                       equivalent=False,
+                       timeout=None):
+    '''
+    Asynchronous version of ``search``. The search runs on a worker pool of
+    ``config.SEARCH_CONCURRENCY`` threads, so the calling event loop is never
+    blocked by git, and at most that many searches run at once; any further
+    searches wait for a free worker.
+
+    When ``config.SEARCH_PROCESSES`` is set, the worker pool is made of that
+    many processes instead, so that searches can use several cores.
+
+    The ``timeout`` includes the time spent waiting for a worker; searches
+    whose time runs out before a worker picks them up are not started.
+
+    Accepts the same arguments as ``search``, apart from ``repos``.
+    '''
+    kwargs = {'pr_num': pr_num,
+              'commit': commit,
+              'fetch': fetch,
+              'branch_limiters': branch_limiters,
+              'tag_limiters': tag_limiters,
+              'max_age': max_age,
+              'equivalent': equivalent}
+    return await _run_async(search, kwargs, timeout)
+
+
+async def list_prs_async(rev_range, fetch=False, max_age=None, timeout=None):
+    '''
+    Asynchronous version of ``list_prs``, run on the same worker pool as
+    ``search_async``. Accepts the same arguments as ``list_prs``, apart from
+    ``callback``.
+    '''
+    kwargs = {'rev_range': rev_range,
+              'fetch': fetch,
+              'max_age': max_age}
+    return await _run_async(list_prs, kwargs, timeout)
+
+
+async def _run_async(func, kwargs, timeout):
+    '''
+    Runs ``search`` or ``list_prs`` with the given arguments on the
+    ``search_async`` worker pool. See ``search_async``.
+    '''
+    # Imported here rather than at the top, as asyncio is slow to import and
+    # the CLI does not need it
+    import asyncio
+    loop = asyncio.get_event_loop()
+    kwargs = dict(kwargs,
+                  func=func,
+                  deadline=None if timeout is None else time.time() + timeout)
+    metrics.add_gauge('version_check_searches_queued', 1)
+    if not config.SEARCH_PROCESSES:
+        return await loop.run_in_executor(
+            _get_executor(), functools.partial(_run_queued_search, **kwargs)
+        )
+
+    # Worker processes cannot report when they pick a search up, so searches
+    # count as queued until they finish
+    try:
+        ret, worker_metrics = await loop.run_in_executor(
+            _get_process_executor(), functools.partial(_call_in_worker, _settings(), _search_until, kwargs)
+        )
+    except concurrent.futures.process.BrokenProcessPool:
+        _discard_process_executor()
+        return {'error': 'ERROR: the search worker exited unexpectedly.'}
+    finally:
+        metrics.add_gauge('version_check_searches_queued', -1)
+    metrics.merge(*worker_metrics)
+    return ret
+
+
+def start_search_workers():
+    '''
+    Starts the ``config.SEARCH_PROCESSES`` search worker processes used by
+    ``search_async``, if any, ahead of the first search. Call this before
+    starting other threads, so the workers are forked from a quiet process.
+    '''
+    if config.SEARCH_PROCESSES:
+        executor = _get_process_executor()
+        concurrent.futures.wait([executor.submit(os.getpid) for _ in range(config.SEARCH_PROCESSES)])
+
+
+def start_precompute():
+    '''
+    Starts precomputing, after every fetch from this process, the
+    containment of the pull requests merged since the previous fetch. Meant
+    for long-running processes, which are likely to be asked about them.
+    '''
+    _PRECOMPUTER.start()
+
+
+def get_branch_matches(commit, limiters=None):
+    '''
+    Returns a list of branches that contain the given commit. Raises
+    ``util.CommandError`` if git fails.
+
+    commit
+        The commit sha to search for or match against.
+
+    limiters
+        The list of branches to limit the search. Glob patterns, such as
+        ``2017.*``, are supported. Default: search all branches.
+    '''
+    with metrics.timer('branch_search'):
+        return _get_matches(commit, 'branch', limiters=limiters)
+
+
+def get_tag_matches(commit, limiters=None):
+    '''
+    Returns the list of published tags that contain the given commit. Raises
+    ``util.CommandError`` if git fails.
+
+    commit
+        The commit sha to search for or match against.
+
+    limiters
+        The list of tags to limit the search. Glob patterns, such as
+        ``v3000*``, are supported. Default: search all tags.
+    '''
+    with metrics.timer('tag_search'):
+        return _get_matches(commit, 'tag', limiters=limiters)
+
+
+def parse_tag(tag):
+    '''
+    Returns a tuple of the release line and a sortable version key for the
+    given release tag, or None if the tag is not a release tag.
+
+    Releases before 3000 form lines by major and minor version (``v2017.7.2``
+    is in the ``2017.7`` line); later releases form lines by major version
+    (``v3000.1`` is in the ``3000`` line). Release candidates sort before the
+    release they precede.
+
+    tag
+        The tag name to parse.
+    '''
+    match = _TAG_RE.match(tag)
+    if match is None:
+        return None
+
+    major, minor, patch, rc_num = match.groups()
+    numbers = [int(major), int(minor or 0), int(patch or 0)]
+    if numbers[0] >= 3000:
+        line = major
+    elif minor is not None:
+        line = '{0}.{1}'.format(major, minor)
+    else:
+        return None
+
+    if rc_num is None:
+        key = tuple(numbers) + (1, 0)
+    else:
+        key = tuple(numbers) + (0, int(rc_num))
+    return line, key
+
+
+def get_release_lines(tags):
+    '''
+    Returns a dictionary mapping each release line to its tags, sorted by
+    version. Tags that are not release tags are left out.
+
+    tags
+        The tag names to group.
+    '''
+    lines = {}
+    for tag in tags:
+        parsed = parse_tag(tag)
+        if parsed is not None:
+            lines.setdefault(parsed[0], []).append(tag)
+    for line_tags in lines.values():
+        line_tags.sort(key=lambda tag: parse_tag(tag)[1])
+    return lines
+
+
+def get_first_tags(tags):
+    '''
+    Returns a dictionary mapping each release line to the first release in
+    that line, from the given list of tags containing a commit.
+
+    tags
+        The tags that contain the commit.
+    '''
+    return dict((line, line_tags[0]) for line, line_tags in get_release_lines(tags).items())
+
+
+def get_equivalent_matches(commit, branch_limiters=None, tag_limiters=None):
+    '''
+    Returns a dictionary of the ``commits`` that make the same change as the
+    given commit according to the patch-id index, and the ``branches`` and
+    ``tags`` that contain any of them.
+
+    commit
+        The commit sha to find equivalents of.
+
+    branch_limiters
+        The list of branches to limit the search. Default: search all branches.
+
+    tag_limiters
+        The list of tags to limit the search. Default: search all tags.
+    '''
+    sha = resolve_commit(commit)
+    commits = patchindex.equivalent_commits(sha) if sha else []
+
+    branches = set()
+    tags = set()
+    for equivalent_commit in commits:
+        branches.update(get_branch_matches(equivalent_commit, limiters=branch_limiters))
+        tags.update(get_tag_matches(equivalent_commit, limiters=tag_limiters))
+
+    return {'commits': commits,
+            'branches': sorted(branches),
+            'tags': sorted(tags)}
+
+
+def get_ref_tips(kind):
+    '''
+    Returns a dictionary mapping each searchable ref name to the commit it
+    currently points to. Annotated tags are peeled to their commits.
+
+    kind
+        The kind of ref to list: ``branch`` for the branches of
+        ``config.REMOTE``, or ``tag`` for the published tags.
+    '''
+    if kind == 'branch':
+        prefix = 'refs/remotes/{0}/'.format(config.REMOTE)
+    else:
+        prefix = 'refs/tags/'
+
+    tips = {}
+    for ref, sha in backend.get().ref_tips(prefix).items():
+        name = ref[len(prefix):]
+        if kind == 'branch':
+            # handle other possible remotes - don't include them
+            if '/' in name or name == 'HEAD':
+                continue
+        elif not name.startswith('v'):
+            continue
+        tips[name] = sha
+
+    return tips
+
+
+def refs_stamp():
+    '''
+    Returns a value that changes whenever a fetch or ``git pack-refs`` updates
+    the refs of the repository at ``config.GIT_DIR``. This only stats files,
+    so it is cheap enough to check on every query.
+    '''
+    return backend.refs_stamp(config.GIT_DIR)
+
+
+def resolve_commit(commit):
+    '''
+    Returns the full sha of the given commit, or None if the commit cannot
+    be found or the abbreviated sha is ambiguous.
+
+    commit
+        The commit sha, or abbreviated sha, to resolve.
+    '''
+    if _ABBREV_RE.match(commit):
+        candidates = commit_candidates(commit)
+        if len(candidates) == 1:
+            return candidates[0]
+        if candidates:
+            return None
+    return backend.get().resolve(commit)
+
+
+def commit_candidates(commit):
+    '''
+    Returns the sorted full shas of the commits the given abbreviated sha
+    could name, found with the object id index.
+
+    commit
+        The abbreviated commit sha.
+    '''
+    git_backend = backend.get()
+    return [sha for sha in oidindex.lookup(commit) if git_backend.resolve(sha) == sha]
+
+
+def _search(pr_num, commit, fetch, branch_limiters, tag_limiters, max_age, equivalent):
+    '''
+    Runs a search of the repository at ``config.GIT_DIR``. Takes the same
+    arguments as ``search``.
     '''
     ret = {}
 
     # Fetch latest from GitHub
     if fetch:
-        util.cmd_run(['git', config.GIT_DIR, 'fetch', config.REMOTE])
+        with metrics.timer('fetch'):
+            fetch_remote(max_age=max_age)
 
     # Get commit sha from PR number
     if pr_num:
@@ -49,112 +506,707 @@ def search(pr_num=None,
     if isinstance(commit, dict):
         return commit
 
-    # Get matching branches and tags based on limiters (if any)
+    # Resolve an abbreviated sha once, rather than in every git command
+    if not pr_num and _ABBREV_RE.match(commit):
+        candidates = commit_candidates(commit)
+        if len(candidates) > 1:
+            listed = ', '.join(candidates[:_MAX_CANDIDATES])
+            if len(candidates) > _MAX_CANDIDATES:
+                listed += ' and {0} more'.format(len(candidates) - _MAX_CANDIDATES)
+            return {'error': 'ERROR: the commit \'{0}\' is ambiguous. It could be: {1}'.format(commit, listed),
+                    'candidates': candidates}
+        if candidates:
+            commit = candidates[0]
+
+    # Get matching branches and tags based on limiters (if any). Tags and
+    # branches are searched at the same time.
     if branch_limiters:
         # Branch limiter is passed
-        ret['branches'] = get_branch_matches(commit, limiters=branch_limiters)
         if tag_limiters:
             # Tag limiter is passed with a branch limiter
-            ret['tags'] = get_tag_matches(commit, limiters=tag_limiters)
+            ret['tags'], ret['branches'] = _run_sharded([
+                (get_tag_matches, (commit, tag_limiters)),
+                (get_branch_matches, (commit, branch_limiters)),
+            ])
+        else:
+            ret['branches'] = get_branch_matches(commit, limiters=branch_limiters)
     elif tag_limiters:
         # Only a tag limiter is passed
         ret['tags'] = get_tag_matches(commit, limiters=tag_limiters)
     else:
         # Search all branches and tags
-        ret['branches'] = get_branch_matches(commit)
-        ret['tags'] = get_tag_matches(commit)
+        ret['tags'], ret['branches'] = _run_sharded([
+            (get_tag_matches, (commit,)),
+            (get_branch_matches, (commit,)),
+        ])
+
+    if ret.get('tags'):
+        ret['first_tags'] = get_first_tags(ret['tags'])
+
+    if equivalent:
+        with metrics.timer('equivalent_search'):
+            equivalent_ret = get_equivalent_matches(commit,
+                                                    branch_limiters=branch_limiters,
+                                                    tag_limiters=tag_limiters)
+        for key in ('branches', 'tags'):
+            if key not in ret:
+                equivalent_ret.pop(key, None)
+        ret['equivalent'] = equivalent_ret
 
     return ret
 
 
-def get_branch_matches(commit, limiters=None):
+def _list_prs(rev_range, fetch, max_age, callback):
     '''
-    Returns a list of branches that contain the given commit.
+    Lists the pull requests merged in a range of the repository at
+    ``config.GIT_DIR``. Takes the same arguments as ``list_prs``.
+    '''
+    if fetch:
+        with metrics.timer('fetch'):
+            fetch_remote(max_age=max_age)
+
+    start, _, end = rev_range.rpartition('..')
+    revs = []
+    for name, exclude in ((end, False), (start, True)):
+        if not name and not exclude:
+            return {'error': 'ERROR: the range \'{0}\' has no end.'.format(rev_range)}
+        if not name:
+            continue
+        sha = _resolve_ref(name)
+        if sha is None:
+            return {'error': 'ERROR: \'{0}\' is not a known branch, tag or commit.'.format(name)}
+        revs.append('^' + sha if exclude else sha)
+
+    pull_requests = []
+    try:
+        for pr_num, sha in _iter_prs(revs):
+            pull_request = {'number': pr_num, 'commit': sha}
+            pull_requests.append(pull_request)
+            if callback is not None:
+                callback(pull_request)
+    except util.CommandError as exc:
+        return {'error': 'ERROR: {0}'.format(exc)}
+
+    return {'pull_requests': pull_requests}
+
+
+def _iter_prs(revs):
+    '''
+    Yields the number of each pull request merged in the commits that
+    ``git rev-list`` lists for the given revisions, with the commit that
+    brought it in, newest first. See ``list_prs``.
+    '''
+    pr_heads = prindex.heads()
+    seen = set()
+    for line in backend.get().lines(['rev-list', '--format=%H %s'] + revs):
+        if line.startswith(b'commit '):
+            continue
+        sha, _, subject = line.decode(errors='replace').partition(' ')
+        match = _MERGE_SUBJECT_RE.match(subject) or _SQUASH_SUBJECT_RE.search(subject)
+        pr_num = int(match.group(1)) if match else pr_heads.get(sha)
+        if pr_num is None or pr_num in seen:
+            continue
+        seen.add(pr_num)
+        yield pr_num, sha
+
+
+def _resolve_ref(name):
+    '''
+    Returns the commit a branch of ``config.REMOTE``, a tag or a commit sha
+    names, or None if it names none of them.
+    '''
+    for kind in ('branch', 'tag'):
+        sha = get_ref_tips(kind).get(name)
+        if sha is not None:
+            return sha
+    if name.startswith('-'):
+        return None
+    return resolve_commit(name)
+
+
+def _get_matches(commit, kind, limiters=None):
+    '''
+    Returns the list of refs of the given kind that contain the given commit.
+    The limiters are applied to the ref names before any containment work is
+    done, so only the selected refs are searched. Answers are served from the
+    containment cache where the ref has not moved since they were stored;
+    only the remaining refs are handed to git.
+
+    Matches are returned in limiter order when limiters are given, and sorted
+    otherwise.
 
     commit
         The commit sha to search for or match against.
 
+    kind
+        The kind of ref to search: ``branch`` or ``tag``.
+
     limiters
-        The list of branches to limit the search. Default: search all branches.
+        The list of ref names or glob patterns to limit the search.
     '''
-    branches = []
-    cmd_ret = util.cmd_run(['git', config.GIT_DIR, 'branch', '-a', '--contains', commit])
-    cmd_ret = cmd_ret['stdout'].decode()
-    strip_len = len('/'.join(['remotes', config.REMOTE])) + 1
-    for line in cmd_ret.splitlines():
-        line = line.strip()
-        if line.startswith('remotes/'):
-            # strip off remotes/REMOTE/
-            line = line[strip_len:]
-            # handle other possible remotes - don't include them
-            if '/' in line:
-                continue
-            if line.startswith('HEAD'):
-                continue
-            branches.append(line)
+    tips = get_ref_tips(kind)
+    ref_count = len(tips)
+    if limiters:
+        names = _select_refs(tips, limiters)
+        tips = dict((name, tips[name]) for name in names)
+    if not tips:
+        return []
+
+    sha = resolve_commit(commit)
+    if sha is None:
+        return []
+
+    if kind == 'tag':
+        matches = _search_tags(sha, tips, ref_count)
+    else:
+        matches = _contained(sha, kind, tips, ref_count)
 
     if limiters:
-        ret = []
-        for limiter in limiters:
-            if limiter in branches:
-                ret.append(limiter)
-        return ret
+        return [name for name in names if name in matches]
+    return sorted(matches)
 
-    return branches
 
+def _contained(sha, kind, tips, ref_count):
+    '''
+    Returns the set of the given refs that contain the commit. Answers come
+    from the reachability snapshot when it is enabled and up to date for a
+    ref, then from the containment cache, and only then from git.
 
-def get_tag_matches(commit, limiters=None):
+    sha
+        The full commit sha to search for.
+
+    kind
+        The kind of ref to search: ``branch`` or ``tag``.
+
+    tips
+        A dictionary mapping each ref name to search to the commit it points
+        to.
+
+    ref_count
+        The total number of refs of this kind in the repository.
     '''
-    Returns the list of published tags that contain the given commit.
+    matches = set()
+    if config.DAG_ENGINE:
+        ref_count_before = len(tips)
+        matches, tips = dag.contained(sha, kind, tips)
+        metrics.inc('version_check_containment_answers_total', ref_count_before - len(tips), source='dag')
+        if not tips:
+            return matches
 
-    commit
-        The commit sha to search for or match against.
+    cached, stale = cache.lookup(sha, kind, tips)
+    metrics.inc('version_check_containment_answers_total', len(tips) - len(stale), source='cache')
+    metrics.inc('version_check_containment_answers_total', len(stale), source='git')
+    matches.update(cached)
+    if stale:
+        # Only name the stale refs explicitly when it narrows the search
+        found = _run_contains(sha, kind, names=stale if len(stale) < ref_count else None)
+        found = set(name for name in found if name in tips)
+        cache.store(sha, kind, dict((name, tips[name]) for name in stale), found)
+        matches.update(found)
+    return matches
+
+
+def _search_tags(sha, tips, ref_count):
+    '''
+    Returns the set of the given tags that contain the commit. The tags are
+    split into as many shards of whole release lines as ``_shard_count``
+    allows, plus one of the tags that are not release tags, and the shards are
+    searched at the same time.
+
+    sha
+        The full commit sha to search for.
+
+    tips
+        A dictionary mapping each tag name to search to the commit it points
+        to.
+
+    ref_count
+        The total number of tags in the repository.
+    '''
+    lines = get_release_lines(tips)
+    shard_count = _shard_count()
+    shards = [[] for _ in range(shard_count)]
+    for index, line in enumerate(sorted(lines)):
+        shards[index % shard_count].extend(lines[line])
+
+    if config.TAG_SEARCH == 'bisect':
+        calls = [(_bisect_tags, (sha, dict((tag, tips[tag]) for tag in shard), ref_count))
+                 for shard in shards if shard]
+    else:
+        calls = [(_contained, (sha, 'tag', dict((tag, tips[tag]) for tag in shard), ref_count))
+                 for shard in shards if shard]
+    others = dict((name, tip) for name, tip in tips.items() if parse_tag(name) is None)
+    if others:
+        calls.append((_contained, (sha, 'tag', others, ref_count)))
+
+    matches = set()
+    for found in _run_sharded(calls):
+        matches.update(found)
+    return matches
+
+
+def _bisect_tags(sha, tips, ref_count):
+    '''
+    Returns the set of the given tags that contain the commit, using a binary
+    search within each release line.
+
+    This assumes that, within a release line, once a commit is in a release
+    it is in every later release, so that only the first containing release
+    of each line needs to be found. That does not hold for a release that is
+    not an ancestor of the next one in its line, which is why this is only
+    used when ``config.TAG_SEARCH`` is ``bisect``. All the given lines are
+    searched together: each round asks git about the middle tag of every
+    unfinished line at once, so a search takes about ``log2`` of the longest
+    line's length rounds. Tags the reachability snapshot answers exactly are
+    not inferred, and tags that are not release tags are searched directly.
+
+    sha
+        The full commit sha to search for.
+
+    tips
+        A dictionary mapping each tag name to search to the commit it points
+        to.
+
+    ref_count
+        The total number of tags in the repository.
+    '''
+    matches = set()
+    if config.DAG_ENGINE:
+        ref_count_before = len(tips)
+        matches, tips = dag.contained(sha, 'tag', tips)
+        metrics.inc('version_check_containment_answers_total', ref_count_before - len(tips), source='dag')
+        if not tips:
+            return matches
+
+    lines = get_release_lines(tips)
+    others = dict((name, tip) for name, tip in tips.items() if parse_tag(name) is None)
+    if others:
+        matches.update(_contained(sha, 'tag', others, ref_count))
+
+    bounds = dict((line, (0, len(line_tags))) for line, line_tags in lines.items())
+    while True:
+        probes = {}
+        for line, (low, high) in bounds.items():
+            if low < high:
+                probes[line] = lines[line][(low + high) // 2]
+        if not probes:
+            break
+
+        found = _contained(sha, 'tag', dict((tag, tips[tag]) for tag in probes.values()), ref_count)
+        for line, tag in probes.items():
+            low, high = bounds[line]
+            middle = (low + high) // 2
+            bounds[line] = (low, middle) if tag in found else (middle + 1, high)
+
+    for line, (low, _) in bounds.items():
+        matches.update(lines[line][low:])
+    return matches
+
+
+def _run_sharded(calls):
+    '''
+    Runs the given ``(function, args)`` calls at the same time, the first in
+    the calling thread and the others on a pool of ``_shard_count`` threads,
+    and returns their results in order. The calls share the calling thread's
+    deadline. Calls made from the pool's own threads run one after the other,
+    so that they never wait for the pool they are running on.
+    '''
+    if len(calls) < 2 or _shard_count() < 2 or getattr(_SHARD, 'active', False):
+        return [func(*args) for func, args in calls]
+
+    remaining = util.remaining_time()
+    deadline = None if remaining is None else time.monotonic() + remaining
+    executor = _get_shard_executor()
+    futures = [executor.submit(_run_shard, deadline, func, args) for func, args in calls[1:]]
+    func, args = calls[0]
+    results = [func(*args)]
+    results.extend(future.result() for future in futures)
+    return results
+
+
+def _shard_count():
+    '''
+    Returns the number of shards a search may run at once:
+    ``config.CONTAINMENT_SHARDS``, or the number of CPUs if it is 0.
+    '''
+    return config.CONTAINMENT_SHARDS or os.cpu_count() or 1
+
+
+def _run_shard(deadline, func, args):
+    '''
+    Runs a call on the shard pool with the given deadline, in
+    ``time.monotonic`` seconds.
+    '''
+    _SHARD.active = True
+    with util.deadline(None if deadline is None else deadline - time.monotonic()):
+        return func(*args)
+
+
+def _select_refs(tips, limiters):
+    '''
+    Returns the names of the refs selected by the limiters, in limiter order.
+    Glob patterns select every matching ref, sorted by name.
+
+    tips
+        The dictionary of available refs, keyed by name.
 
     limiters
-        The list of tags to limit the search. Default: search all tags.
+        The list of ref names or glob patterns.
     '''
-    tags = []
-    cmd_ret = util.cmd_run(['git', config.GIT_DIR, 'tag', '--contains', commit])
-    cmd_ret = cmd_ret['stdout'].decode()
-    for line in cmd_ret.splitlines():
-        if line.startswith('v'):
-            tags.append(line)
+    names = []
+    for limiter in limiters:
+        if any(char in limiter for char in '*?['):
+            selected = sorted(name for name in tips if fnmatch.fnmatchcase(name, limiter))
+        else:
+            selected = [limiter] if limiter in tips else []
+        for name in selected:
+            if name not in names:
+                names.append(name)
+    return names
 
-    if limiters:
-        ret = []
-        for limiter in limiters:
-            if limiter in tags:
-                ret.append(limiter)
-        return ret
 
-    return tags
+def _run_contains(commit, kind, names=None):
+    '''
+    Asks git which refs of the given kind contain the given commit. Raises
+    ``util.CommandError`` if git fails, so that a failure is never taken,
+    and cached, as the commit not being contained.
+
+    commit
+        The commit sha to search for.
+
+    kind
+        The kind of ref to search: ``branch`` or ``tag``.
+
+    names
+        The list of ref names to evaluate. Default: evaluate all refs.
+    '''
+    remote_prefix = config.REMOTE + '/'
+    if kind == 'branch':
+        cmd = ['branch', '-r', '--contains', commit]
+        if names is not None:
+            cmd.append('--list')
+            cmd.extend(remote_prefix + name for name in names)
+    else:
+        cmd = ['tag', '--contains', commit]
+        if names is not None:
+            cmd.append('--list')
+            cmd.extend(names)
+
+    cmd_ret = backend.get().run(cmd)
+    if cmd_ret['retcode'] != 0:
+        output = cmd_ret['stdout']
+        if isinstance(output, bytes):
+            output = output.decode(errors='replace')
+        raise util.CommandError(output.strip() or 'git {0} failed'.format(cmd[0]))
+
+    found = []
+    for line in cmd_ret['stdout'].decode().splitlines():
+        line = line.strip()
+        if kind == 'branch':
+            if ' -> ' in line or not line.startswith(remote_prefix):
+                continue
+            # strip off REMOTE/
+            line = line[len(remote_prefix):]
+        found.append(line)
+
+    return found
+
+
+def fetch_remote(max_age=None):
+    '''
+    Fetches the latest branches, tags, and pull request refs from
+    ``config.REMOTE``, then refreshes the pull request index. Concurrent
+    callers share a single fetch. Returns the ``util.cmd_run`` result of the
+    fetch, or None if it was skipped.
+
+    max_age
+        Skip the fetch if the refs were updated within this many seconds.
+        Defaults to None, which always fetches.
+    '''
+    return _FETCHER.fetch(max_age=max_age)
+
+
+def refs_updated_at():
+    '''
+    Returns the time the refs were last fetched from upstream, in seconds
+    since the epoch, or None if they have never been fetched.
+    '''
+    return _FETCHER.last_updated()
+
+
+def update_dag():
+    '''
+    Brings the reachability snapshot up to date with the current branches and
+    tags.
+    '''
+    refs = {}
+    for kind in ('branch', 'tag'):
+        for name, tip in get_ref_tips(kind).items():
+            refs[(kind, name)] = tip
+    dag.update(refs)
+
+
+def update_patch_index():
+    '''
+    Adds the commits of the current branches and tags to the patch-id index.
+    '''
+    tips = set()
+    for kind in ('branch', 'tag'):
+        tips.update(get_ref_tips(kind).values())
+    patchindex.update(tips)
 
 
 def get_sha(pr_num):
     '''
     Returns a git commit sha from the provided pull request number.
 
+    The sha is looked up in the pull request index. Pull requests that are
+    not in the index yet are fetched into it first.
+
     pr_num
         The number of the PR.
     '''
     pr_num = pr_num.lstrip('#')
-    branch_name = 'pr-{0}'.format(pr_num)
 
-    # Create local branch from PR number
-    branch_cmd = util.cmd_run(
-        ['git',
-         config.GIT_DIR,
-         'fetch',
-         config.REMOTE,
-         'pull/{0}/head:{1}'.format(pr_num, branch_name)])
-    if branch_cmd['retcode'] != 0:
-        return {'error': 'ERROR: {0}'.format(branch_cmd['stdout'])}
+    with metrics.timer('pr_lookup'):
+        sha = prindex.lookup(pr_num)
+    if sha is None:
+        with metrics.timer('pr_fetch'):
+            branch_cmd = prindex.fetch_one(pr_num)
+        if branch_cmd['retcode'] != 0:
+            return {'error': 'ERROR: {0}'.format(branch_cmd['stdout'])}
+        sha = prindex.lookup(pr_num)
+        if sha is None:
+            return {'error': 'ERROR: pull request {0} was not found.'.format(pr_num)}
 
-    # Get the commit at the HEAD of the local branch
-    cmd_ret = util.cmd_run(['git', config.GIT_DIR, 'rev-parse', branch_name])
-    sha = cmd_ret['stdout'].strip()
+    return sha
 
-    # Clean up the newly created branch
-    util.cmd_run(['git', config.GIT_DIR, 'branch', '-D', branch_name])
 
-    return sha
+def _fetch_remote():
+    '''
+    Fetches branches, tags, and pull request refs in a single ``git fetch``,
+    then refreshes the pull request index and, if enabled, runs repository
+    maintenance and updates the reachability snapshot and patch-id index.
+    '''
+    refspecs = [refspec.format(remote=config.REMOTE)
+                for refspec in config.FETCH_REFSPECS + config.TAG_REFSPECS]
+    tips_before = _all_tips() if _PRECOMPUTER.enabled else None
+    with metrics.timer('fetch_refs'):
+        cmd_ret = backend.get().run(fetcher.fetch_args(refspecs + prindex.refspecs()))
+        prindex.refresh()
+    if cmd_ret['retcode'] == 0 and config.MAINTAIN_AFTER_FETCH:
+        with metrics.timer('maintain'):
+            maintenance.maintain(report=False)
+    if cmd_ret['retcode'] == 0 and config.DAG_ENGINE:
+        with metrics.timer('dag_update'):
+            update_dag()
+    if cmd_ret['retcode'] == 0 and config.PATCH_INDEX:
+        with metrics.timer('patch_index_update'):
+            update_patch_index()
+    if cmd_ret['retcode'] == 0 and tips_before:
+        with metrics.timer('precompute_scan'):
+            _PRECOMPUTER.submit(_merged_since(tips_before))
+    return cmd_ret
+
+
+def _all_tips():
+    '''
+    Returns the set of commits the searchable branches and tags point to.
+    '''
+    return set(get_ref_tips('branch').values()) | set(get_ref_tips('tag').values())
+
+
+def _merged_since(tips_before):
+    '''
+    Returns the commits to precompute for the pull requests merged into the
+    branches and tags since they pointed to the given commits: the commit
+    that merged each pull request and the pull request's head, newest first.
+    '''
+    new_tips = _all_tips() - tips_before
+    if not new_tips:
+        return []
+
+    commits = []
+    revs = sorted(new_tips) + ['^' + tip for tip in sorted(tips_before)]
+    try:
+        for pr_num, sha in _iter_prs(revs):
+            commits.append(sha)
+            head = prindex.lookup(pr_num)
+            if head is not None and head != sha:
+                commits.append(head)
+            if len(commits) >= config.PRECOMPUTE_MAX_COMMITS:
+                break
+    except util.CommandError as exc:
+        LOG.warning('Unable to list the pull requests merged by the fetch: %s', exc)
+    return commits
+
+
+def _precompute(commit):
+    '''
+    Computes the branches and tags that contain the commit, which stores the
+    answers in the containment cache.
+    '''
+    get_branch_matches(commit)
+    get_tag_matches(commit)
+
+
+def _run_queued_search(**kwargs):
+    '''
+    Runs a search taken off the ``search_async`` worker pool's queue, keeping
+    the queued and running search gauges up to date.
+    '''
+    metrics.add_gauge('version_check_searches_queued', -1)
+    metrics.add_gauge('version_check_searches_running', 1)
+    try:
+        return _search_until(**kwargs)
+    finally:
+        metrics.add_gauge('version_check_searches_running', -1)
+
+
+def _run_in_repos(repos, func, kwargs):
+    '''
+    Calls the function once for each of the given repositories, each in a
+    repository worker process with that repository's ``GIT_DIR`` and
+    ``REMOTE`` in effect, and returns the results keyed by repository name.
+    Unknown repositories and failed calls are returned as errors.
+    '''
+    settings = _settings()
+    results = {}
+    jobs = {}
+    for name in repos:
+        repo = config.REPOS.get(name)
+        if repo is None:
+            results[name] = {'error': 'ERROR: repository \'{0}\' is not configured.'.format(name)}
+            continue
+        repo_settings = dict(settings,
+                             GIT_DIR=repo['git_dir'],
+                             REMOTE=repo.get('remote', config.REMOTE))
+        jobs[name] = _get_repo_executor().submit(_call_in_worker, repo_settings, func, kwargs)
+
+    for name, job in jobs.items():
+        try:
+            results[name], worker_metrics = job.result()
+            metrics.merge(*worker_metrics)
+        except Exception as exc:
+            results[name] = {'error': 'ERROR: repository \'{0}\' failed: {1}'.format(name, exc)}
+    return results
+
+
+def _search_until(func=search, deadline=None, **kwargs):
+    '''
+    Runs a search, with ``search`` or ``list_prs``, that must finish by the
+    given deadline, in seconds since the epoch. The search is not started if
+    the deadline has already passed.
+    '''
+    if deadline is not None:
+        kwargs['timeout'] = deadline - time.time()
+        if kwargs['timeout'] <= 0:
+            return {'error': 'ERROR: the search took too long and was stopped.'}
+    return func(**kwargs)
+
+
+def _settings():
+    '''
+    Returns the current config settings, to be sent to worker processes.
+    '''
+    return dict((key, value) for key, value in vars(config).items() if key.isupper())
+
+
+def _call_in_worker(settings, func, kwargs):
+    '''
+    Calls the function in a worker process, with the given config settings
+    in effect. Returns the result, and the metrics recorded during the call.
+    '''
+    for key, value in settings.items():
+        setattr(config, key, value)
+    metrics.reset()
+    return func(**kwargs), metrics.snapshot()
+
+
+def _get_repo_executor():
+    '''
+    Returns the worker process pool used by ``search_repos``, creating it on
+    first use.
+    '''
+    global _REPO_EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _REPO_EXECUTOR is None:
+            _REPO_EXECUTOR = concurrent.futures.ProcessPoolExecutor(
+                max_workers=config.REPO_WORKERS
+            )
+        return _REPO_EXECUTOR
+
+
+def _get_process_executor():
+    '''
+    Returns the worker process pool used by ``search_async`` when
+    ``config.SEARCH_PROCESSES`` is set, creating it on first use.
+    '''
+    global _PROCESS_EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _PROCESS_EXECUTOR is None:
+            _PROCESS_EXECUTOR = concurrent.futures.ProcessPoolExecutor(
+                max_workers=config.SEARCH_PROCESSES
+            )
+        return _PROCESS_EXECUTOR
+
+
+def _discard_process_executor():
+    '''
+    Discards the ``search_async`` worker process pool after one of its
+    processes died, so that the next search starts a new one.
+    '''
+    global _PROCESS_EXECUTOR
+    with _EXECUTOR_LOCK:
+        executor, _PROCESS_EXECUTOR = _PROCESS_EXECUTOR, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+def _get_shard_executor():
+    '''
+    Returns the thread pool that runs the shards of searches, creating it on
+    first use.
+    '''
+    global _SHARD_EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _SHARD_EXECUTOR is None:
+            _SHARD_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+                max_workers=_shard_count()
+            )
+        return _SHARD_EXECUTOR
+
+
+def _get_executor():
+    '''
+    Returns the worker pool used by ``search_async``, creating it on first use.
+    '''
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.SEARCH_CONCURRENCY
+            )
+        return _EXECUTOR
+
+
+def _reset_after_fork():
+    '''
+    Give a forked child, such as a repository worker process, its own worker
+    pools, fetch scheduler and (stopped) precomputer; the parent's threads do
+    not exist in the child.
+    '''
+    global _EXECUTOR, _EXECUTOR_LOCK, _REPO_EXECUTOR, _PROCESS_EXECUTOR, _SHARD_EXECUTOR, _FETCHER, _PRECOMPUTER
+    _EXECUTOR = None
+    _SHARD_EXECUTOR = None
+    _EXECUTOR_LOCK = threading.Lock()
+    _REPO_EXECUTOR = None
+    _PROCESS_EXECUTOR = None
+    _FETCHER = fetcher.FetchScheduler(_fetch_remote)
+    _PRECOMPUTER = precompute.Precomputer(_precompute)
+
+
+_FETCHER = fetcher.FetchScheduler(_fetch_remote)
+_PRECOMPUTER = precompute.Precomputer(_precompute)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
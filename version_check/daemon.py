@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+'''
+A long-running search daemon, and the client the CLI uses to talk to it.
+
+Every CLI invocation otherwise starts from scratch: it imports everything,
+opens the repository, starts git workers and loads the indexes before it can
+look at a single ref. ``version-check --serve`` keeps all of that warm in a
+daemon listening on the Unix socket at ``config.DAEMON_SOCKET``, and the CLI
+hands its searches to the daemon whenever one is running.
+
+The protocol is one JSON object per line: the client sends the ``version``
+of version_check and the ``search`` arguments, and the daemon replies with
+the ``result`` of ``core.search``, or an ``error``.
+'''
+
+# Import Python libs
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+
+# Import version_check libs
+import version_check.config as config
+import version_check.core as core
+
+LOG = logging.getLogger(__name__)
+
+# Seconds the client waits to connect to the daemon
+_CONNECT_TIMEOUT = 0.5
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    '''
+    Handles the requests of a single client connection.
+    '''
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+                if request.get('version') != config.VERSION:
+                    reply = {'error': 'version mismatch: the daemon runs {0}'.format(config.VERSION)}
+                else:
+                    reply = {'result': core.search(**request['search'])}
+            except (ValueError, KeyError, TypeError) as exc:
+                reply = {'error': 'invalid request: {0}'.format(exc)}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Unix socket server handling each connection in its own thread.
+    '''
+    daemon_threads = True
+
+
+def serve(path=None):
+    '''
+    Run the daemon in the foreground until it is interrupted or terminated.
+    Returns an error dictionary if it could not be started.
+
+    path
+        The path of the Unix socket to listen on. Default:
+        ``config.DAEMON_SOCKET``.
+    '''
+    path = path or config.DAEMON_SOCKET
+    sock = _connect(path)
+    if sock is not None:
+        sock.close()
+        return {'error': 'ERROR: a daemon is already listening on {0}.'.format(path)}
+
+    # Only the user running the daemon may connect to it
+    umask = os.umask(0o077)
+    try:
+        if os.path.exists(path):
+            # Left behind by a daemon that did not exit cleanly
+            os.unlink(path)
+        socket_dir = os.path.dirname(path)
+        if socket_dir and not os.path.exists(socket_dir):
+            os.makedirs(socket_dir)
+        server = _Server(path, _Handler)
+    except (IOError, OSError) as exc:
+        return {'error': 'ERROR: unable to listen on {0}: {1}'.format(path, exc)}
+    finally:
+        os.umask(umask)
+
+    # Warm up the repository and indexes before taking requests
+    core.refs_updated_at()
+    core.get_ref_tips('branch')
+    core.get_ref_tips('tag')
+    core.start_precompute()
+
+    signal.signal(signal.SIGTERM, _terminate)
+    LOG.info('Listening on %s.', path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    return {}
+
+
+def search(search_kwargs, path=None):
+    '''
+    Runs a search in the daemon and returns its result, or None if no daemon
+    is running or it could not complete the search.
+
+    search_kwargs
+        The arguments to pass to ``core.search``.
+
+    path
+        The path of the daemon's Unix socket. Default:
+        ``config.DAEMON_SOCKET``.
+    '''
+    sock = _connect(path or config.DAEMON_SOCKET)
+    if sock is None:
+        return None
+
+    try:
+        with sock:
+            # The search itself may take a while
+            sock.settimeout(None)
+            request = {'version': config.VERSION, 'search': search_kwargs}
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            with sock.makefile('rb') as reply_file:
+                reply = json.loads(reply_file.readline().decode())
+    except (IOError, OSError, ValueError) as exc:
+        LOG.debug('Daemon request failed: %s', exc)
+        return None
+
+    if 'error' in reply:
+        LOG.debug('Daemon refused request: %s', reply['error'])
+        return None
+    return reply['result']
+
+
+def _connect(path):
+    '''
+    Returns a socket connected to the daemon at the given path, or None if
+    there is no daemon listening there.
+    '''
+    if not path or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(_CONNECT_TIMEOUT)
+    try:
+        sock.connect(path)
+    except (IOError, OSError):
+        sock.close()
+        return None
+    return sock
+
+
+def _terminate(signum, frame):
+    '''
+    Handles SIGTERM by stopping the daemon the same way as an interrupt.
+    '''
+    raise KeyboardInterrupt
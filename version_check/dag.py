@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+'''
+In-process commit reachability engine.
+
+Rather than asking git to walk history for every query, this module loads the
+commit graph into compact, array-backed structures: each commit gets an
+integer id, and parents are stored as offset and index arrays. Every searched
+ref is given a bit, and the set of refs that reach each commit is computed by
+propagating bitsets from the ref tips down through the graph in topological
+order. Answering "which refs contain this commit" is then a single lookup of
+that commit's bitset, for all refs at once.
+
+The graph and bitsets are saved to a snapshot file which is memory-mapped for
+lookups, so new processes start warm without reading the whole file. After a
+fetch, the snapshot is extended incrementally: only new commits are added, and
+only the bits of refs that were created, moved, or deleted are recomputed.
+
+Snapshot layout (little-endian)::
+
+    header      magic, oid size, commit count, parent count, row size,
+                ref table size
+    ref table   JSON list of [kind, name, tip] per bit (null for free bits)
+    oids        commit ids, sorted
+    offsets     (commit count + 1) uint32 offsets into the parents array
+    parents     uint32 commit indexes
+    rows        one bitset of ``row size`` bytes per commit
+'''
+
+# Import Python libs
+import array
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+# Import version_check libs
+import version_check.backend as backend
+import version_check.config as config
+
+LOG = logging.getLogger(__name__)
+
+_MAGIC = b'VCDAG001'
+_HEADER = struct.Struct('<8sIIIII')
+
+_LOCK = threading.Lock()
+_SNAPSHOTS = {}
+
+
+def contained(sha, kind, tips):
+    '''
+    Returns a tuple of the set of refs known to contain the given commit,
+    and a dictionary of the refs the snapshot cannot answer for because they
+    are missing from it or have moved since it was written.
+
+    sha
+        The full commit sha to look up.
+
+    kind
+        The kind of ref being searched: ``branch`` or ``tag``.
+
+    tips
+        A dictionary mapping each ref name to the commit it currently
+        points to.
+    '''
+    snapshot = _get_snapshot()
+    if snapshot is None:
+        return set(), tips
+
+    row = snapshot.row(sha)
+    matches = set()
+    stale = {}
+    for name, tip in tips.items():
+        bit = snapshot.bits.get((kind, name, tip))
+        if bit is None:
+            stale[name] = tip
+        elif row >> bit & 1:
+            matches.add(name)
+    return matches, stale
+
+
+def update(refs):
+    '''
+    Brings the snapshot up to date with the given refs, extending the
+    existing snapshot when there is one and building it from scratch
+    otherwise.
+
+    refs
+        A dictionary mapping ``(kind, name)`` to the commit each ref to be
+        indexed points to.
+    '''
+    path = snapshot_path()
+    with _LOCK:
+        snapshot = _get_snapshot()
+        if snapshot is None:
+            changed = None
+        else:
+            changed = _changed_refs(snapshot.refs, refs)
+            if not changed:
+                return
+
+        if changed is None or len(changed) > config.DAG_REBUILD_THRESHOLD:
+            graph = _Graph.build(refs)
+        else:
+            graph = snapshot.graph()
+            if not graph.extend(refs, changed):
+                graph = None
+        if graph is None:
+            return
+
+        try:
+            graph.write(path)
+        except (IOError, OSError) as exc:
+            LOG.warning('Unable to write reachability snapshot %s: %s', path, exc)
+            return
+        _SNAPSHOTS.pop(path, None)
+
+
+def snapshot_path():
+    '''
+    Returns the path of the snapshot file for the repository at
+    ``config.GIT_DIR``.
+    '''
+    repo = hashlib.sha1(config.GIT_DIR.encode()).hexdigest()[:12]
+    return config.DAG_SNAPSHOT_PATH.format(repo=repo)
+
+
+def _changed_refs(indexed, refs):
+    '''
+    Returns the set of ``(kind, name)`` refs that were created, moved, or
+    deleted relative to the indexed refs.
+
+    indexed
+        The list of ``[kind, name, tip]`` refs in a snapshot.
+
+    refs
+        A dictionary mapping ``(kind, name)`` to the commit each ref points
+        to now.
+    '''
+    current = dict(((kind, name), tip) for kind, name, tip in filter(None, indexed))
+    changed = set(key for key, tip in refs.items() if current.get(key) != tip)
+    changed.update(key for key in current if key not in refs)
+    return changed
+
+
+def _get_snapshot():
+    '''
+    Returns the memory-mapped snapshot for the repository at
+    ``config.GIT_DIR``, reopening it if the file was replaced, or None if
+    there is no usable snapshot.
+    '''
+    path = snapshot_path()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    snapshot = _SNAPSHOTS.get(path)
+    if snapshot is None or snapshot.stamp != stamp:
+        try:
+            snapshot = _Snapshot(path, stamp)
+        except (IOError, OSError, ValueError) as exc:
+            LOG.warning('Ignoring unreadable reachability snapshot %s: %s', path, exc)
+            return None
+        _SNAPSHOTS[path] = snapshot
+    return snapshot
+
+
+class _Snapshot(object):
+    '''
+    A read-only, memory-mapped snapshot.
+    '''
+
+    def __init__(self, path, stamp):
+        self.stamp = stamp
+        with open(path, 'rb') as snapshot_file:
+            self._mm = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.oid_size, self.count, parent_count, self.row_size, refs_size = \
+            _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError('not a reachability snapshot')
+
+        offset = _HEADER.size
+        self.refs = json.loads(self._mm[offset:offset + refs_size].decode())
+        offset += refs_size
+        self._oids = offset
+        offset += self.oid_size * self.count
+        self._offsets = offset
+        offset += 4 * (self.count + 1)
+        self._parents = offset
+        offset += 4 * parent_count
+        self._rows = offset
+        if len(self._mm) != offset + self.row_size * self.count:
+            raise ValueError('truncated reachability snapshot')
+
+        self.bits = {}
+        for bit, ref in enumerate(self.refs):
+            if ref is not None:
+                self.bits[tuple(ref)] = bit
+
+    def find(self, oid):
+        '''
+        Returns the index of the given binary commit id, or None.
+        '''
+        low, high = 0, self.count
+        size = self.oid_size
+        while low < high:
+            middle = (low + high) // 2
+            start = self._oids + middle * size
+            candidate = self._mm[start:start + size]
+            if candidate < oid:
+                low = middle + 1
+            elif candidate > oid:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def row(self, sha):
+        '''
+        Returns the bitset of refs reaching the given commit. Commits that
+        are not in the snapshot are not reached by any ref in it.
+        '''
+        try:
+            index = self.find(bytes.fromhex(sha))
+        except ValueError:
+            return 0
+        if index is None:
+            return 0
+        start = self._rows + index * self.row_size
+        return int.from_bytes(self._mm[start:start + self.row_size], 'little')
+
+    def graph(self):
+        '''
+        Returns a mutable copy of the snapshot's graph.
+        '''
+        graph = _Graph()
+        size = self.oid_size
+        graph.oids = [self._mm[self._oids + i * size:self._oids + (i + 1) * size]
+                      for i in range(self.count)]
+        graph.index = dict((oid, i) for i, oid in enumerate(graph.oids))
+
+        offsets = array.array('I')
+        offsets.frombytes(self._mm[self._offsets:self._parents])
+        parents = array.array('I')
+        parents.frombytes(self._mm[self._parents:self._rows])
+        graph.parents = [parents[offsets[i]:offsets[i + 1]] for i in range(self.count)]
+
+        row_size = self.row_size
+        graph.reach = [int.from_bytes(self._mm[self._rows + i * row_size:self._rows + (i + 1) * row_size],
+                                      'little')
+                       for i in range(self.count)]
+        graph.refs = [tuple(ref) if ref is not None else None for ref in self.refs]
+        return graph
+
+
+class _Graph(object):
+    '''
+    A mutable commit graph with per-commit ref bitsets.
+    '''
+
+    def __init__(self):
+        self.oids = []
+        self.index = {}
+        self.parents = []
+        self.reach = []
+        self.refs = []
+
+    @classmethod
+    def build(cls, refs):
+        '''
+        Builds the graph of every commit reachable from the given refs.
+        Returns None if the history could not be read.
+        '''
+        graph = cls()
+        order = graph._add_commits(refs.values(), [])
+        if order is None:
+            return None
+
+        graph.refs = [(kind, name, tip) for (kind, name), tip in sorted(refs.items())]
+        for bit, (_, _, tip) in enumerate(graph.refs):
+            index = graph.index.get(bytes.fromhex(tip))
+            if index is not None:
+                graph.reach[index] |= 1 << bit
+
+        # rev-list lists children before their parents
+        reach = graph.reach
+        for index in order:
+            bits = reach[index]
+            if bits:
+                for parent in graph.parents[index]:
+                    reach[parent] |= bits
+        return graph
+
+    def extend(self, refs, changed):
+        '''
+        Adds the commits that are new since the graph was built and
+        recomputes the bits of the changed refs. Returns False if the new
+        history could not be read.
+        '''
+        old_tips = set(ref[2] for ref in self.refs if ref is not None)
+        new_tips = set(refs[key] for key in changed if key in refs) - old_tips
+        if self._add_commits(new_tips, old_tips) is None:
+            return False
+
+        # Free the bits of changed refs and clear them from every commit
+        mask = 0
+        free = []
+        for bit, ref in enumerate(self.refs):
+            if ref is None:
+                free.append(bit)
+            elif (ref[0], ref[1]) in changed:
+                mask |= 1 << bit
+                self.refs[bit] = None
+                free.append(bit)
+        if mask:
+            keep = ~mask
+            self.reach = [bits & keep for bits in self.reach]
+
+        # Give changed refs that still exist a bit, and mark what they reach
+        for key in sorted(changed):
+            if key not in refs:
+                continue
+            bit = free.pop(0) if free else len(self.refs)
+            if bit == len(self.refs):
+                self.refs.append(None)
+            self.refs[bit] = (key[0], key[1], refs[key])
+            self._mark(refs[key], 1 << bit)
+        return True
+
+    def write(self, path):
+        '''
+        Atomically writes the graph to a snapshot file.
+        '''
+        count = len(self.oids)
+        order = sorted(range(count), key=self.oids.__getitem__)
+        position = [0] * count
+        for new_index, old_index in enumerate(order):
+            position[old_index] = new_index
+
+        offsets = array.array('I', [0])
+        parents = array.array('I')
+        for old_index in order:
+            parents.extend(position[parent] for parent in self.parents[old_index])
+            offsets.append(len(parents))
+
+        row_size = max(1, (len(self.refs) + 7) // 8)
+        refs = json.dumps([list(ref) if ref is not None else None for ref in self.refs]).encode()
+        oid_size = len(self.oids[0]) if self.oids else 20
+
+        snapshot_dir = os.path.dirname(path)
+        if snapshot_dir and not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir, mode=0o700)
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as snapshot_file:
+            snapshot_file.write(_HEADER.pack(_MAGIC, oid_size, count, len(parents), row_size, len(refs)))
+            snapshot_file.write(refs)
+            for old_index in order:
+                snapshot_file.write(self.oids[old_index])
+            snapshot_file.write(offsets.tobytes())
+            snapshot_file.write(parents.tobytes())
+            for old_index in order:
+                snapshot_file.write(self.reach[old_index].to_bytes(row_size, 'little'))
+        os.replace(tmp_path, path)
+
+    def _add_commits(self, tips, exclude):
+        '''
+        Adds the commits reachable from the tips but not from the excluded
+        commits to the graph. Returns the indexes of the added commits,
+        children before parents, or None if git failed.
+        '''
+        tips = list(tips)
+        if not tips:
+            return []
+
+        revs = '\n'.join(tips + ['^' + sha for sha in exclude]) + '\n'
+        cmd_ret = backend.get().run(['rev-list', '--parents', '--topo-order', '--stdin'],
+                                    stdin=revs.encode())
+        if cmd_ret['retcode'] != 0:
+            LOG.warning('Unable to read commit history: %s', cmd_ret['stdout'])
+            return None
+
+        lines = [line.split() for line in cmd_ret['stdout'].decode().splitlines()]
+        added = []
+        for line in lines:
+            oid = bytes.fromhex(line[0])
+            if oid not in self.index:
+                self.index[oid] = len(self.oids)
+                self.oids.append(oid)
+                self.parents.append(array.array('I'))
+                self.reach.append(0)
+                added.append(oid)
+        for line in lines:
+            index = self.index[bytes.fromhex(line[0])]
+            if index < len(self.oids) - len(added):
+                continue
+            self.parents[index] = array.array(
+                'I', [self.index[oid] for oid in map(bytes.fromhex, line[1:]) if oid in self.index]
+            )
+        return [self.index[oid] for oid in added]
+
+    def _mark(self, tip, bit):
+        '''
+        Sets the bit on every commit reachable from the tip.
+        '''
+        start = self.index.get(bytes.fromhex(tip))
+        if start is None:
+            return
+        reach = self.reach
+        stack = [start]
+        while stack:
+            index = stack.pop()
+            if reach[index] & bit:
+                continue
+            reach[index] |= bit
+            stack.extend(parent for parent in self.parents[index] if not reach[parent] & bit)
+
+
+def _reset_after_fork():
+    '''
+    Give a forked child its own lock, in case another thread held the
+    parent's at the time of the fork.
+    '''
+    global _LOCK
+    _LOCK = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
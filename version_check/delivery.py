@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+'''
+Delivery of messages to Slack ``response_url`` endpoints.
+
+Messages are POSTed through a shared, bounded pool of HTTP clients (at most
+``config.SLACK_DELIVERY_MAX_CLIENTS`` requests at once, with any further
+requests waiting for a free client). Each attempt has connect and request
+timeouts, and failed attempts are retried with exponential backoff: network
+errors, timeouts, rate limiting (HTTP 429, honoring ``Retry-After``) and
+server errors are retried, other client errors are not.
+
+When pycurl is installed, the curl-based client is used, which keeps
+connections to Slack alive between messages. Otherwise Tornado's simple
+client is used.
+'''
+
+# Import Python libs
+import json
+import logging
+import random
+import time
+import weakref
+
+# Import tornado libs
+from tornado import gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.simple_httpclient
+
+# Import version_check libs
+import version_check.config as config
+import version_check.metrics as metrics
+
+try:
+    # Requires pycurl
+    import tornado.curl_httpclient
+    HAS_PYCURL = True
+except ImportError:
+    HAS_PYCURL = False
+
+LOG = logging.getLogger(__name__)
+
+# HTTP clients, one per IOLoop
+_CLIENTS = weakref.WeakKeyDictionary()
+
+
+@gen.coroutine
+def post(url, post_data):
+    '''
+    POST the given data as JSON to the given URL, retrying failed attempts.
+    Returns True if the data was delivered, and False if every attempt failed.
+
+    url
+        The URL to POST to.
+
+    post_data
+        The data to send.
+    '''
+    body = json.dumps(post_data).encode('utf-8')
+    start = time.perf_counter()
+    attempts = config.SLACK_DELIVERY_RETRIES + 1
+    for attempt in range(attempts):
+        request = tornado.httpclient.HTTPRequest(
+            url=url,
+            method='POST',
+            headers={'Content-Type': 'application/json'},
+            body=body,
+            connect_timeout=config.SLACK_DELIVERY_CONNECT_TIMEOUT,
+            request_timeout=config.SLACK_DELIVERY_TIMEOUT
+        )
+        try:
+            response = yield _client().fetch(request)
+        except tornado.httpclient.HTTPError as exc:
+            # HTTP errors and timeouts; timeouts have code 599
+            code, error, response = exc.code, exc, exc.response
+        except (IOError, OSError) as exc:
+            code, error, response = 599, exc, None
+        else:
+            metrics.inc('version_check_slack_delivery_attempts_total', status=response.code)
+            metrics.observe('version_check_slack_delivery_seconds',
+                            time.perf_counter() - start, outcome='delivered')
+            return True
+
+        metrics.inc('version_check_slack_delivery_attempts_total', status=code)
+        retry = code == 429 or code >= 500
+        if not retry or attempt == attempts - 1:
+            LOG.error('Unable to deliver message to Slack: %s', error)
+            break
+
+        delay = config.SLACK_DELIVERY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+        if code == 429 and response is not None:
+            try:
+                delay = max(delay, float(response.headers.get('Retry-After', 0)))
+            except ValueError:
+                pass
+        LOG.warning('Delivery to Slack failed (%s). Retrying in %.1f seconds.', error, delay)
+        yield gen.sleep(delay)
+
+    metrics.observe('version_check_slack_delivery_seconds',
+                    time.perf_counter() - start, outcome='failed')
+    return False
+
+
+def _client():
+    '''
+    Returns the HTTP client used for deliveries on the current IOLoop,
+    creating it on first use.
+    '''
+    io_loop = tornado.ioloop.IOLoop.current()
+    client = _CLIENTS.get(io_loop)
+    if client is None:
+        if HAS_PYCURL:
+            client_class = tornado.curl_httpclient.CurlAsyncHTTPClient
+        else:
+            client_class = tornado.simple_httpclient.SimpleAsyncHTTPClient
+        client = _CLIENTS[io_loop] = client_class(
+            force_instance=True,
+            max_clients=config.SLACK_DELIVERY_MAX_CLIENTS
+        )
+    return client
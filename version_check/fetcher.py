@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+'''
+Shared, debounced fetching from upstream.
+
+Fetches requested while another fetch of the same repository is running wait
+for that fetch instead of starting their own, and fetches requested within
+``config.FETCH_DEBOUNCE`` seconds of a completed fetch are skipped. Callers
+that can tolerate slightly older refs may pass a larger staleness bound with
+``max_age``; the time the refs were last updated is available from
+``last_updated``. It is the time of the last successful full fetch, recorded
+in a stamp file in the git directory so that fetches made by other
+version-check processes count too. Fetches of single pull requests do not
+move it, as they leave the branches and tags as they were.
+
+Fetches are kept lean: version-check only ever reads commits, trees and tags,
+so with ``config.FETCH_FILTER`` set the repository is a partial clone that
+never downloads file contents, and only the refs named by the configured
+refspecs are fetched.
+'''
+
+# Import Python libs
+import concurrent.futures
+import os
+import threading
+import time
+
+# Import version_check libs
+import version_check.backend as backend
+import version_check.config as config
+import version_check.util as util
+
+# Touched in the git directory after every successful full fetch
+_STAMP = 'version_check_fetched'
+
+
+class FetchScheduler(object):
+    '''
+    Runs fetches through the given function, sharing concurrent fetches.
+
+    fetch_func
+        The function that performs a fetch of the repository at
+        ``config.GIT_DIR``. It is called without arguments and returns the
+        ``util.cmd_run`` result of the fetch.
+    '''
+
+    def __init__(self, fetch_func):
+        self._fetch_func = fetch_func
+        self._lock = threading.Lock()
+        self._running = {}
+        self._finished = {}
+
+    def fetch(self, max_age=None):
+        '''
+        Fetches from upstream unless the refs were updated within the last
+        ``max_age`` seconds (or ``config.FETCH_DEBOUNCE`` seconds, whichever
+        is longer). Returns the result of the fetch function, or None if the
+        fetch was skipped.
+
+        max_age
+            The maximum acceptable age of the refs, in seconds. Default:
+            always fetch, apart from debouncing.
+        '''
+        git_dir = config.GIT_DIR
+        bound = max(max_age or 0, config.FETCH_DEBOUNCE)
+        with self._lock:
+            running = self._running.get(git_dir)
+            if running is None:
+                updated = self.last_updated()
+                if updated is not None and time.time() - updated < bound:
+                    return None
+                running = self._running[git_dir] = concurrent.futures.Future()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            # Share the fetch that is already running
+            return running.result()
+
+        try:
+            result = self._fetch_func()
+        except Exception as exc:
+            with self._lock:
+                del self._running[git_dir]
+            running.set_exception(exc)
+            raise
+
+        with self._lock:
+            if result['retcode'] == 0:
+                self._finished[git_dir] = time.time()
+                _touch_stamp()
+            del self._running[git_dir]
+        running.set_result(result)
+        return result
+
+    def last_updated(self):
+        '''
+        Returns the time the refs of the repository at ``config.GIT_DIR``
+        were last fetched, in seconds since the epoch, or None if unknown.
+        Fetches run by other version-check processes, such as from a cron
+        job, are included.
+        '''
+        times = []
+        finished = self._finished.get(config.GIT_DIR)
+        if finished is not None:
+            times.append(finished)
+        try:
+            times.append(os.path.getmtime(
+                os.path.join(backend.git_dir_path(config.GIT_DIR), _STAMP)
+            ))
+        except OSError:
+            pass
+        return max(times) if times else None
+
+
+def _touch_stamp():
+    '''
+    Records a successful full fetch of the repository at ``config.GIT_DIR``.
+    '''
+    path = os.path.join(backend.git_dir_path(config.GIT_DIR), _STAMP)
+    try:
+        with open(path, 'a'):
+            os.utime(path, None)
+    except (IOError, OSError):
+        pass
+
+
+def fetch_args(refspecs):
+    '''
+    Returns the ``git fetch`` arguments that fetch the given refspecs from
+    ``config.REMOTE``, with the configured filter and tag options.
+
+    refspecs
+        The refspecs to fetch.
+    '''
+    args = ['fetch']
+    if config.FETCH_NO_TAGS:
+        args.append('--no-tags')
+    if config.FETCH_FILTER:
+        args.append('--filter={0}'.format(config.FETCH_FILTER))
+    return args + [config.REMOTE] + list(refspecs)
+
+
+def clone(url=None):
+    '''
+    Clones the repository at ``config.GIT_DIR`` from the given URL, without
+    checking out any files and with the configured filter and tag options.
+    Returns the ``util.cmd_run`` result of the clone, or None if the
+    repository already exists.
+
+    url
+        The URL to clone from. Default: ``config.REMOTE_URL``.
+    '''
+    path = backend.git_dir_path(config.GIT_DIR)
+    if os.path.exists(path):
+        return None
+
+    args = ['git', 'clone', '--quiet', '--no-checkout', '--origin', config.REMOTE]
+    if config.FETCH_NO_TAGS:
+        args.append('--no-tags')
+    if config.FETCH_FILTER:
+        args.append('--filter={0}'.format(config.FETCH_FILTER))
+    if os.path.basename(os.path.normpath(path)) == '.git':
+        # Clone into the .git directory of a work tree that stays empty
+        target = os.path.dirname(os.path.normpath(path))
+    else:
+        args.append('--bare')
+        target = path
+    return util.cmd_run(args + [url or config.REMOTE_URL, target])
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+'''
+Load test for the Slack App.
+
+Generates a synthetic repository (see ``version_check.synthetic``), starts the
+Slack App on it, and fires signed slash commands at its event endpoint at a
+fixed rate, the way Slack would send them. Each command's ``response_url``
+points at a stand-in for Slack, started alongside the app, which receives the
+app's replies. No network access is needed.
+
+Commands are drawn from a weighted mix of kinds:
+
+pr
+    A random pull request number.
+
+hot
+    One of a handful of pull request numbers, as when many people ask about
+    the same recent merge; these are mostly answered from the result cache.
+
+commit
+    The abbreviated head commit of a random pull request.
+
+prs
+    The pull requests between two consecutive tags.
+
+The report gives the latency of the app's acknowledgement of each command, the
+end-to-end latency from sending a command to receiving its results, by kind,
+and how many commands were rejected as busy, answered with an error, or never
+answered at all.
+
+The load generator runs in the same process as the app, so set
+``SEARCH_PROCESSES`` with ``--set`` to keep searches off the app's process.
+
+Usage:
+
+.. code-block:: bash
+
+    python -m version_check.loadtest
+    python -m version_check.loadtest --rate 50 --requests 1000 --mix pr=1,hot=3
+    python -m version_check.loadtest --set SEARCH_PROCESSES=4 --set SLACK_QUEUE_SIZE=8
+    python -m version_check.loadtest --slack-delay 0.2 --slack-error-rate 0.1
+'''
+
+# Import Python libs
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import urllib.parse
+
+# Import tornado libs
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.simple_httpclient
+import tornado.web
+
+# Import version_check libs
+import version_check.backend as backend
+import version_check.bench as bench
+import version_check.config as config
+import version_check.core as core
+import version_check.slack_app as slack_app
+import version_check.synthetic as synthetic
+
+KINDS = ['pr', 'hot', 'commit', 'prs']
+
+DEFAULT_MIX = 'pr=5,hot=3,commit=1,prs=1'
+
+# Signing secret shared by the load generator and the app under test
+_SECRET = 'version-check-load-test'
+
+# Pull requests in the hot set
+_HOT_SET = 5
+
+
+def sign(body, secret, timestamp=None):
+    '''
+    Returns the headers Slack sends to sign the given request body, as checked
+    by the Slack App's ``_validate_slack_signature``.
+
+    body
+        The request body.
+
+    secret
+        The Slack signing secret.
+
+    timestamp
+        The request time, in seconds since the epoch. Default: now.
+    '''
+    timestamp = str(int(time.time() if timestamp is None else timestamp))
+    base = 'v0:{0}:{1}'.format(timestamp, body)
+    signature = 'v0=' + hmac.new(secret.encode(), msg=base.encode(), digestmod=hashlib.sha256).hexdigest()
+    return {'X-Slack-Request-Timestamp': timestamp, 'X-Slack-Signature': signature}
+
+
+class _FakeSlackHandler(tornado.web.RequestHandler):
+    '''
+    Stand-in for Slack's ``response_url`` endpoints; records the messages the
+    app posts for each command.
+    '''
+
+    def initialize(self, load_test):
+        self.load_test = load_test
+
+    def data_received(self, chunk):
+        pass
+
+    async def post(self, command_id):
+        load_test = self.load_test
+        if load_test.slack_delay:
+            await asyncio.sleep(load_test.slack_delay)
+        if random.random() < load_test.slack_error_rate:
+            self.set_status(500)
+            return
+        load_test.received(int(command_id), json.loads(self.request.body.decode()))
+
+
+class LoadTest(object):
+    '''
+    A single load test run against a Slack App listening on this process'
+    IOLoop.
+
+    items
+        Dictionary of the search items to draw commands from, keyed by kind.
+
+    mix
+        Dictionary of the weight of each kind of command.
+
+    slack_delay
+        Seconds the stand-in for Slack waits before accepting a message.
+
+    slack_error_rate
+        Fraction of messages the stand-in for Slack fails with an HTTP 500.
+    '''
+
+    def __init__(self, items, mix, slack_delay=0.0, slack_error_rate=0.0):
+        self.items = items
+        self.mix = mix
+        self.slack_delay = slack_delay
+        self.slack_error_rate = slack_error_rate
+        self.commands = []
+        self._rand = random.Random(0)
+
+    def received(self, command_id, message):
+        '''
+        Records a message the app posted for a command. Messages with
+        attachments are the command's results.
+        '''
+        command = self.commands[command_id]
+        if 'attachments' not in message or command['done'] is not None:
+            return
+        command['done'] = time.perf_counter()
+        command['error'] = any(attachment.get('color') == 'danger' for attachment in message['attachments'])
+        command['finished'].set()
+
+    async def run(self, app_port, slack_port, rate, requests, wait):
+        '''
+        Sends the given number of commands at the given rate, then waits up to
+        ``wait`` seconds for the results of the commands still in progress.
+        '''
+        client = tornado.simple_httpclient.SimpleAsyncHTTPClient(force_instance=True, max_clients=1000)
+        app_url = 'http://127.0.0.1:{0}/salt-version'.format(app_port)
+        kinds = sorted(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+
+        start = time.perf_counter()
+        tasks = []
+        for command_id in range(requests):
+            delay = start + command_id / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind = self._rand.choices(kinds, weights)[0]
+            command = {'kind': kind,
+                       'text': self._rand.choice(self.items[kind]),
+                       'sent': None,
+                       'ack': None,
+                       'status': None,
+                       'busy': False,
+                       'done': None,
+                       'error': False,
+                       'finished': asyncio.Event()}
+            self.commands.append(command)
+            response_url = 'http://127.0.0.1:{0}/respond/{1}'.format(slack_port, command_id)
+            tasks.append(asyncio.ensure_future(self._send(client, app_url, command, response_url)))
+        self.send_seconds = time.perf_counter() - start
+
+        if tasks:
+            await asyncio.wait(tasks)
+        waiters = [asyncio.ensure_future(command['finished'].wait())
+                   for command in self.commands if not command['finished'].is_set()]
+        if waiters:
+            await asyncio.wait(waiters, timeout=wait)
+            for waiter in waiters:
+                waiter.cancel()
+        client.close()
+
+    async def _send(self, client, app_url, command, response_url):
+        '''
+        Sends a signed slash command to the app and records its
+        acknowledgement.
+        '''
+        body = urllib.parse.urlencode({'text': command['text'], 'response_url': response_url})
+        command['sent'] = time.perf_counter()
+        try:
+            response = await client.fetch(app_url, method='POST', body=body,
+                                          headers=sign(body, _SECRET), raise_error=False)
+            command['status'] = response.code
+            if response.code == 200 and response.body:
+                # Commands rejected while the app is busy are answered in the
+                # acknowledgement itself
+                command['busy'] = json.loads(response.body.decode()).get('response_type') == 'ephemeral'
+        except (IOError, OSError) as exc:
+            command['status'] = str(exc)
+        command['ack'] = time.perf_counter()
+        if command['status'] != 200 or command['busy']:
+            command['finished'].set()
+
+    def report(self):
+        '''
+        Returns a summary of the run: the number of commands sent and the rate
+        they were sent at, the acknowledgement and end-to-end latencies in
+        seconds, overall and by kind, and the commands that were rejected as
+        busy, failed to be acknowledged, were answered with an error, or were
+        never answered.
+        '''
+        acks = [command['ack'] - command['sent'] for command in self.commands if command['ack'] is not None]
+        summary = {'sent': len(self.commands),
+                   'rate': len(self.commands) / self.send_seconds if self.send_seconds else 0.0,
+                   'ack': _latencies(acks),
+                   'busy': sum(1 for command in self.commands if command['busy']),
+                   'failed': sum(1 for command in self.commands if command['status'] != 200),
+                   'errors': sum(1 for command in self.commands if command['error']),
+                   'lost': sum(1 for command in self.commands
+                               if command['status'] == 200 and not command['busy'] and command['done'] is None),
+                   'end_to_end': {}}
+        for kind in [None] + KINDS:
+            durations = [command['done'] - command['sent'] for command in self.commands
+                         if command['done'] is not None and kind in (None, command['kind'])]
+            if durations:
+                summary['end_to_end'][kind or 'all'] = _latencies(durations)
+        return summary
+
+
+def main():
+    '''
+    Run the load test and print its report.
+    '''
+    args = parse_args()
+    # The app warns about every command it turns away when overloaded
+    logging.basicConfig(level=logging.ERROR)
+    for setting in args.set or []:
+        key, _, value = setting.partition('=')
+        setattr(config, key, json.loads(value))
+
+    try:
+        mix = dict((kind, float(weight)) for kind, _, weight in
+                   (entry.partition('=') for entry in args.mix.split(',')))
+    except ValueError:
+        print('ERROR: --mix must be a list of KIND=WEIGHT, e.g. {0}'.format(DEFAULT_MIX))
+        sys.exit(1)
+    unknown = set(mix) - set(KINDS)
+    if unknown:
+        print('ERROR: unknown command kinds: {0}'.format(', '.join(sorted(unknown))))
+        sys.exit(1)
+
+    summary = run(args.shape, mix, args.rate, args.requests, args.wait,
+                  slack_delay=args.slack_delay, slack_error_rate=args.slack_error_rate)
+    print_report(summary)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(summary, json_file, indent=2, sort_keys=True)
+            json_file.write('\n')
+
+
+def run(shape, mix, rate, requests, wait, slack_delay=0.0, slack_error_rate=0.0):
+    '''
+    Generates a repository of the given shape, starts the Slack App on it and
+    runs a load test against it. Returns the report of ``LoadTest.report``.
+
+    shape
+        The name of the repository shape in ``bench.SHAPES``.
+
+    mix
+        Dictionary of the weight of each kind of command.
+
+    rate
+        Commands sent per second.
+
+    requests
+        The number of commands to send.
+
+    wait
+        Seconds to wait for outstanding results after the last command.
+
+    slack_delay
+        Seconds the stand-in for Slack waits before accepting a message.
+
+    slack_error_rate
+        Fraction of messages the stand-in for Slack fails with an HTTP 500.
+    '''
+    workdir = tempfile.mkdtemp(prefix='version-check-loadtest-')
+    saved = dict((key, getattr(config, key))
+                 for key in ('GIT_DIR', 'REMOTE', 'CACHE_PATH', 'DAG_SNAPSHOT_PATH', 'PATCH_INDEX_PATH'))
+    saved_secret = slack_app.SLACK_SIGNING_SECRET
+    try:
+        repo = synthetic.make_repo(workdir, **bench.SHAPES[shape])
+        config.GIT_DIR = repo['git_dir']
+        config.REMOTE = 'origin'
+        if config.CACHE_PATH:
+            config.CACHE_PATH = os.path.join(workdir, 'cache.db')
+        config.DAG_SNAPSHOT_PATH = os.path.join(workdir, 'dag-{repo}.snapshot')
+        config.PATCH_INDEX_PATH = os.path.join(workdir, 'patchids.db')
+        core.fetch_remote()
+        core.start_search_workers()
+        slack_app.SLACK_SIGNING_SECRET = _SECRET
+
+        load_test = LoadTest(_search_items(repo), mix,
+                             slack_delay=slack_delay, slack_error_rate=slack_error_rate)
+        io_loop = tornado.ioloop.IOLoop.current()
+        app_port = _listen(slack_app.make_app())
+        slack_port = _listen(tornado.web.Application([
+            (r'/respond/(\d+)', _FakeSlackHandler, {'load_test': load_test}),
+        ]))
+        io_loop.run_sync(lambda: load_test.run(app_port, slack_port, rate, requests, wait))
+        return load_test.report()
+    finally:
+        slack_app.SLACK_SIGNING_SECRET = saved_secret
+        backend.close_all()
+        for key, value in saved.items():
+            setattr(config, key, value)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(summary):
+    '''
+    Print the report of a load test.
+    '''
+    print('Sent {0} commands at {1:.1f}/s'.format(summary['sent'], summary['rate']))
+    print('Busy: {0}  Failed: {1}  Errors: {2}  Lost: {3}'.format(
+        summary['busy'], summary['failed'], summary['errors'], summary['lost']))
+    print('{0:<12} {1:>6} {2:>10} {3:>10} {4:>10} {5:>10}'.format(
+        'latency', 'count', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'max (ms)'))
+    rows = [('ack', summary['ack'])]
+    rows.extend(('e2e ' + kind, summary['end_to_end'][kind])
+                for kind in ['all'] + KINDS if kind in summary['end_to_end'])
+    for name, latencies in rows:
+        print('{0:<12} {1:>6} {2:>10.1f} {3:>10.1f} {4:>10.1f} {5:>10.1f}'.format(
+            name, latencies['count'], latencies['p50'] * 1000, latencies['p95'] * 1000,
+            latencies['p99'] * 1000, latencies['max'] * 1000))
+
+
+def _search_items(repo):
+    '''
+    Returns the search items of each kind of command for the given synthetic
+    repository.
+    '''
+    pull_requests = [str(pr_num) for pr_num in repo['pull_requests']]
+    tags = sorted(repo['tags'], key=lambda tag: core.parse_tag(tag)[1])
+    items = {'pr': pull_requests,
+             'hot': pull_requests[-_HOT_SET:],
+             'commit': [core.get_sha(pr_num)[:10] for pr_num in pull_requests],
+             'prs': ['prs {0}..{1}'.format(older, newer) for older, newer in zip(tags, tags[1:])]}
+    return items
+
+
+def _listen(app):
+    '''
+    Starts serving the application on a free local port and returns the port.
+    '''
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    return sockets[0].getsockname()[1]
+
+
+def _latencies(durations):
+    '''
+    Returns the count and the p50, p95, p99 and maximum of the durations.
+    '''
+    return {'count': len(durations),
+            'p50': bench.percentile(durations, 50),
+            'p95': bench.percentile(durations, 95),
+            'p99': bench.percentile(durations, 99),
+            'max': max(durations) if durations else 0.0}
+
+
+def parse_args():
+    '''
+    Parse the load test options.
+    '''
+    parser = argparse.ArgumentParser(description='Load test the version_check Slack App on a synthetic repository')
+    parser.add_argument('--shape', default='small', choices=sorted(bench.SHAPES),
+                        help='Repository shape to test against. Default: small.')
+    parser.add_argument('--rate', type=float, default=20, help='Commands sent per second. Default: 20.')
+    parser.add_argument('--requests', type=int, default=200, help='Commands to send. Default: 200.')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='Weights of the kinds of command sent ({0}). Default: {1}.'.format(
+                            ', '.join(KINDS), DEFAULT_MIX))
+    parser.add_argument('--wait', type=float, default=30,
+                        help='Seconds to wait for outstanding results after the last command. Default: 30.')
+    parser.add_argument('--slack-delay', type=float, default=0.0,
+                        help='Seconds the stand-in for Slack takes to accept each message.')
+    parser.add_argument('--slack-error-rate', type=float, default=0.0,
+                        help='Fraction of messages the stand-in for Slack fails with an HTTP 500.')
+    parser.add_argument('--set', action='append', metavar='KEY=JSON',
+                        help='Override a config setting for the run, e.g. SLACK_QUEUE_SIZE=8.')
+    parser.add_argument('--json', metavar='FILE', help='Also write the report to this file as JSON.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+'''
+Repository maintenance.
+
+Containment queries spend most of their time walking commits. Git answers
+them much faster when the repository has a commit-graph file, which stores
+each commit's parents and generation number (and, optionally, changed-path
+Bloom filters), and when its refs are packed into a single file. This module
+keeps the repository at ``config.GIT_DIR`` in that state. The commit-graph is
+written in split layers, so each run only adds the commits that arrived since
+the last one.
+'''
+
+# Import Python libs
+import time
+
+# Import version_check libs
+import version_check.backend as backend
+import version_check.config as config
+
+# Settings that make git use, and keep up to date, the commit-graph
+_GIT_CONFIG = [
+    ('core.commitGraph', 'true'),
+    ('gc.writeCommitGraph', 'true'),
+]
+
+
+def maintain(report=True):
+    '''
+    Packs refs and incrementally updates the commit-graph. Returns a
+    dictionary with the ``steps`` that were run and their return codes, and,
+    when ``report`` is set, the ``before`` and ``after`` timings in seconds
+    of a sample branch and tag containment query.
+
+    report
+        Whether or not to time the sample query before and after maintenance.
+        Defaults to ``True``.
+    '''
+    ret = {'steps': []}
+
+    sample = _sample_commit() if report else None
+    if sample:
+        ret['before'] = _time_query(sample)
+
+    for key, value in _GIT_CONFIG:
+        _step(ret, ['config', key, value])
+
+    _step(ret, ['pack-refs', '--all'])
+
+    cmd_ret = _step(ret, ['commit-graph', 'write', '--reachable', '--split', '--changed-paths'])
+    if cmd_ret['retcode'] != 0:
+        # Older versions of git do not support split graphs or Bloom filters
+        _step(ret, ['commit-graph', 'write', '--reachable'])
+
+    if sample:
+        ret['after'] = _time_query(sample)
+
+    return ret
+
+
+def _step(ret, args):
+    '''
+    Runs a maintenance step and records its result.
+    '''
+    cmd_ret = backend.get().run(args)
+    ret['steps'].append({'command': 'git ' + ' '.join(args),
+                         'retcode': cmd_ret['retcode'],
+                         'output': cmd_ret['stdout'].decode(errors='replace').strip()})
+    return cmd_ret
+
+
+def _sample_commit():
+    '''
+    Returns a commit ``config.MAINTAIN_SAMPLE_DEPTH`` first-parent commits
+    behind the remote's default branch (or the oldest one, in shorter
+    histories) to time queries with.
+    '''
+    git_backend = backend.get()
+    for rev in ('{0}/HEAD'.format(config.REMOTE), 'HEAD'):
+        cmd_ret = git_backend.run(
+            ['rev-list', '--first-parent', '--max-count={0}'.format(config.MAINTAIN_SAMPLE_DEPTH), rev]
+        )
+        shas = cmd_ret['stdout'].decode().split()
+        if cmd_ret['retcode'] == 0 and shas:
+            return shas[-1]
+    return None
+
+
+def _time_query(commit):
+    '''
+    Returns the time in seconds taken to find every branch and tag
+    containing the commit.
+    '''
+    git_backend = backend.get()
+    start = time.time()
+    git_backend.run(['branch', '-r', '--contains', commit])
+    git_backend.run(['tag', '--contains', commit])
+    return time.time() - start
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+'''
+In-process metrics: counters, gauges and histograms, with optional labels.
+
+Metrics are recorded on the hot path (every git subprocess, every search
+phase, every cache lookup), so recording is a dictionary update under a lock.
+The CLI prints a summary of them with ``--profile``, and the Slack App serves
+them at ``/metrics`` in the Prometheus text format.
+
+Metrics are kept per process. Work done in worker processes sends its
+metrics back to be merged into the parent's with ``merge``.
+'''
+
+# Import Python libs
+import contextlib
+import os
+import threading
+import time
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Name: (type, help) of every metric
+METRICS = {
+    'version_check_phase_seconds': (
+        'histogram', 'Time spent in each phase of a search.'),
+    'version_check_subprocesses_total': (
+        'counter', 'Subprocesses started, by command.'),
+    'version_check_subprocess_bytes_read_total': (
+        'counter', 'Bytes read from subprocess output, by command.'),
+    'version_check_command_timeouts_total': (
+        'counter', 'Commands killed because their search ran out of time, by command.'),
+    'version_check_containment_answers_total': (
+        'counter', 'Ref containment answers, by source: dag, cache or git.'),
+    'version_check_precomputed_commits_total': (
+        'counter', 'Commits whose containment was precomputed in the background after a fetch.'),
+    'version_check_searches_queued': (
+        'gauge', 'Searches waiting for a free search worker.'),
+    'version_check_searches_running': (
+        'gauge', 'Searches currently running on a search worker.'),
+    'version_check_slack_requests_total': (
+        'counter', 'Slack searches, by how they were answered: cached, coalesced or searched.'),
+    'version_check_slack_delivery_attempts_total': (
+        'counter', 'Attempts to post messages to Slack, by HTTP status (599: no response).'),
+    'version_check_slack_delivery_seconds': (
+        'histogram', 'Time taken to post a message to Slack, including retries, by outcome.'),
+    'version_check_slack_in_flight_searches': (
+        'gauge', 'Distinct Slack searches currently in progress.'),
+    'version_check_slack_request_seconds': (
+        'histogram', 'Time from receiving a Slack command to posting its results.'),
+}
+
+_LOCK = threading.Lock()
+_VALUES = {}
+_HISTOGRAMS = {}
+
+
+def inc(name, value=1, **labels):
+    '''
+    Increments a counter.
+
+    name
+        The name of the counter.
+
+    value
+        The amount to add. Default: 1.
+
+    labels
+        The labels of the series to increment.
+    '''
+    key = (name, _label_key(labels))
+    with _LOCK:
+        _VALUES[key] = _VALUES.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    '''
+    Sets a gauge to the given value.
+    '''
+    key = (name, _label_key(labels))
+    with _LOCK:
+        _VALUES[key] = value
+
+
+def add_gauge(name, value, **labels):
+    '''
+    Adds the given value, which may be negative, to a gauge.
+    '''
+    inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    '''
+    Records an observation in a histogram.
+
+    name
+        The name of the histogram.
+
+    value
+        The observed value, in seconds.
+
+    labels
+        The labels of the series to record the observation in.
+    '''
+    key = (name, _label_key(labels))
+    with _LOCK:
+        histogram = _HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = _HISTOGRAMS[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[0][index] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+
+
+@contextlib.contextmanager
+def timer(phase):
+    '''
+    Context manager that records the time spent in the block as a
+    ``version_check_phase_seconds`` observation for the given phase.
+
+    phase
+        The name of the phase, such as ``fetch`` or ``tag_search``.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('version_check_phase_seconds', time.perf_counter() - start, phase=phase)
+
+
+def get(name, **labels):
+    '''
+    Returns the value of a counter or gauge, or 0 if it was never recorded.
+    '''
+    with _LOCK:
+        return _VALUES.get((name, _label_key(labels)), 0)
+
+
+def snapshot():
+    '''
+    Returns a copy of all recorded metrics: a dictionary of counter and gauge
+    values, and a dictionary of histograms as tuples of the per-bucket counts,
+    sum and count. Both are keyed by ``(name, labels)``, where ``labels`` is a
+    sorted tuple of ``(label, value)`` pairs.
+    '''
+    with _LOCK:
+        values = dict(_VALUES)
+        histograms = dict((key, (list(hist[0]), hist[1], hist[2]))
+                          for key, hist in _HISTOGRAMS.items())
+    return values, histograms
+
+
+def render():
+    '''
+    Returns all recorded metrics in the Prometheus text exposition format.
+    '''
+    values, histograms = snapshot()
+    series = {}
+    for (name, labels), value in values.items():
+        series.setdefault(name, []).append(('', labels, value))
+    for (name, labels), (buckets, total, count) in histograms.items():
+        cumulative = 0
+        for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+            cumulative += bucket
+            series.setdefault(name, []).append(('_bucket', labels + (('le', repr(bound)),), cumulative))
+        series[name].append(('_bucket', labels + (('le', '+Inf'),), count))
+        series[name].append(('_sum', labels, total))
+        series[name].append(('_count', labels, count))
+
+    lines = []
+    for name in sorted(series):
+        metric_type, help_text = METRICS.get(name, ('untyped', ''))
+        if help_text:
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} {1}'.format(name, metric_type))
+        for suffix, labels, value in series[name]:
+            lines.append('{0}{1}{2} {3}'.format(name, suffix, _format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def merge(values, histograms):
+    '''
+    Adds metrics recorded elsewhere, such as in a worker process, to this
+    process' metrics.
+
+    values
+        Counter and gauge values, as returned by ``snapshot``.
+
+    histograms
+        Histograms, as returned by ``snapshot``.
+    '''
+    with _LOCK:
+        for key, value in values.items():
+            _VALUES[key] = _VALUES.get(key, 0) + value
+        for key, (buckets, total, count) in histograms.items():
+            histogram = _HISTOGRAMS.get(key)
+            if histogram is None:
+                histogram = _HISTOGRAMS[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            histogram[0] = [mine + theirs for mine, theirs in zip(histogram[0], buckets)]
+            histogram[1] += total
+            histogram[2] += count
+
+
+def reset():
+    '''
+    Discards all recorded metrics.
+    '''
+    with _LOCK:
+        _VALUES.clear()
+        _HISTOGRAMS.clear()
+
+
+def _label_key(labels):
+    '''
+    Returns a hashable, ordered form of the given labels.
+    '''
+    return tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def _format_labels(labels):
+    '''
+    Formats labels for the Prometheus text format.
+    '''
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for label, value in labels
+    ) + '}'
+
+
+def _reset_after_fork():
+    '''
+    Gives a forked child its own lock and empty metrics, so that it neither
+    deadlocks on a lock held at fork time nor reports its parent's metrics.
+    '''
+    global _LOCK
+    _LOCK = threading.Lock()
+    _VALUES.clear()
+    _HISTOGRAMS.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+'''
+Index of object ids, used to resolve abbreviated commit shas.
+
+Every pack git writes comes with a ``.idx`` file whose main table is the
+sorted array of the pack's object ids, preceded by a fan-out table counting
+the ids that start with each byte. This module memory-maps those tables and
+finds the ids starting with an abbreviation with a binary search in each
+pack, plus a directory listing for loose objects. The set of packs is checked
+on every lookup, so packs added by a fetch, or rewritten by a repack, are
+picked up right away.
+
+Pack index layout (version 2, big-endian)::
+
+    header      magic, version
+    fan-out     256 uint32 cumulative counts of ids by first byte
+    ids         20-byte object ids, sorted
+    ...         CRCs and offsets, not read here
+'''
+
+# Import Python libs
+import bisect
+import mmap
+import os
+import struct
+import threading
+
+# Import version_check libs
+import version_check.backend as backend
+import version_check.config as config
+
+_IDX_MAGIC = b'\xfftOc'
+_IDX_HEADER = struct.Struct('>4sI')
+_FANOUT = struct.Struct('>256I')
+_OID_SIZE = 20
+
+# Abbreviations shorter than this are not resolved, as git does
+MIN_LENGTH = 4
+
+_LOCK = threading.Lock()
+_PACKS = {}
+
+
+class _PackIds(object):
+    '''
+    The sorted object ids of a memory-mapped pack index, as a sequence of
+    20-byte strings that can be binary searched.
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as idx_file:
+            self._mm = mmap.mmap(idx_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = _IDX_HEADER.unpack_from(self._mm, 0)
+        if magic != _IDX_MAGIC or version != 2:
+            self._mm.close()
+            raise ValueError('unsupported pack index: {0}'.format(path))
+        self._fanout = _FANOUT.unpack_from(self._mm, _IDX_HEADER.size)
+        self._start = _IDX_HEADER.size + _FANOUT.size
+
+    def __len__(self):
+        return self._fanout[255]
+
+    def __getitem__(self, index):
+        offset = self._start + index * _OID_SIZE
+        return self._mm[offset:offset + _OID_SIZE]
+
+    def matches(self, low, high):
+        '''
+        Returns the ids from ``low`` to ``high``, inclusive, which must share
+        their first byte.
+        '''
+        first = low[0]
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        start = bisect.bisect_left(self, low, lo, hi)
+        end = bisect.bisect_right(self, high, start, hi)
+        return [self[index] for index in range(start, end)]
+
+
+def lookup(prefix):
+    '''
+    Returns the sorted list of full object ids, of any type, that start with
+    the given hexadecimal prefix. Returns an empty list for prefixes shorter
+    than ``MIN_LENGTH``.
+
+    prefix
+        The abbreviated object id.
+    '''
+    prefix = prefix.lower()
+    if len(prefix) < MIN_LENGTH or len(prefix) > _OID_SIZE * 2:
+        return []
+    try:
+        low = bytes.fromhex(prefix.ljust(_OID_SIZE * 2, '0'))
+        high = bytes.fromhex(prefix.ljust(_OID_SIZE * 2, 'f'))
+    except ValueError:
+        return []
+
+    found = set()
+    for pack in _packs():
+        found.update(oid.hex() for oid in pack.matches(low, high))
+
+    # Loose objects are stored as objects/<first byte>/<rest of the id>
+    loose_dir = os.path.join(_objects_dir(), prefix[:2])
+    try:
+        names = os.listdir(loose_dir)
+    except OSError:
+        names = []
+    found.update(prefix[:2] + name for name in names
+                 if len(name) == _OID_SIZE * 2 - 2 and name.startswith(prefix[2:]))
+
+    return sorted(found)
+
+
+def _packs():
+    '''
+    Returns the pack indexes of the repository at ``config.GIT_DIR``,
+    loading them again if packs were added or removed since they were loaded.
+    '''
+    pack_dir = os.path.join(_objects_dir(), 'pack')
+    try:
+        stamp = tuple(sorted(name for name in os.listdir(pack_dir) if name.endswith('.idx')))
+    except OSError:
+        return []
+
+    with _LOCK:
+        cached = _PACKS.get(config.GIT_DIR)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        packs = []
+        for name in stamp:
+            try:
+                packs.append(_PackIds(os.path.join(pack_dir, name)))
+            except (IOError, OSError, ValueError, struct.error):
+                # Removed by a concurrent repack, or a format we do not read
+                continue
+        _PACKS[config.GIT_DIR] = (stamp, packs)
+        return packs
+
+
+def _objects_dir():
+    '''
+    Returns the path of the objects directory of the repository at
+    ``config.GIT_DIR``.
+    '''
+    return os.path.join(backend.git_dir_path(config.GIT_DIR), 'objects')
+
+
+def _reset_after_fork():
+    '''
+    Give a forked child its own lock, in case another thread held the
+    parent's at the time of the fork.
+    '''
+    global _LOCK
+    _LOCK = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
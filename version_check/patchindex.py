@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+'''
+Index of patch-ids to commits, used to find backported changes.
+
+Pull requests are often backported to release branches by cherry-picking,
+which creates new commits with the same change. ``git patch-id --stable``
+gives every such commit the same id, so commits equivalent to a given commit
+can be found by looking its patch-id up in this index.
+
+Computing patch-ids means diffing every commit, which is far too slow to do
+per query. The index is stored in an SQLite database at
+``config.PATCH_INDEX_PATH`` and updated incrementally after each fetch: only
+the commits reachable from the searched branches and tags that were not
+reachable from the previously indexed tips are diffed.
+'''
+
+# Import Python libs
+import logging
+import sqlite3
+
+# Import version_check libs
+import version_check.cache as cache
+import version_check.config as config
+import version_check.util as util
+
+LOG = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS patch_ids (
+    repo TEXT NOT NULL,
+    commit_sha TEXT NOT NULL,
+    patch_id TEXT NOT NULL,
+    PRIMARY KEY (repo, commit_sha)
+);
+CREATE INDEX IF NOT EXISTS patch_ids_patch_id ON patch_ids (repo, patch_id);
+CREATE TABLE IF NOT EXISTS indexed_tips (
+    repo TEXT NOT NULL,
+    tip TEXT NOT NULL,
+    PRIMARY KEY (repo, tip)
+);
+'''
+
+# Diff options that produce the input ``git patch-id`` expects
+_DIFF_ARGS = ['--no-color', '--no-ext-diff', '--format=commit %H']
+
+
+def update(tips):
+    '''
+    Adds the patch-ids of all non-merge commits reachable from the given tips
+    that have not been indexed yet.
+
+    tips
+        The commit shas of the branches and tags to index.
+    '''
+    conn = cache.connect(config.PATCH_INDEX_PATH, _SCHEMA)
+    if conn is None:
+        return
+
+    tips = set(tips)
+    try:
+        indexed = set(row[0] for row in conn.execute(
+            'SELECT tip FROM indexed_tips WHERE repo = ?', (config.GIT_DIR,)
+        ))
+    except sqlite3.Error as exc:
+        LOG.warning('Patch-id index lookup failed: %s', exc)
+        return
+
+    new_tips = tips - indexed
+    if not new_tips:
+        return
+
+    revs = '\n'.join(sorted(new_tips) + ['^' + tip for tip in sorted(indexed)]) + '\n'
+    cmd_ret = util.cmd_pipe(
+        ['git', config.GIT_DIR, 'log', '-p', '--no-merges', '--stdin'] + _DIFF_ARGS,
+        ['git', config.GIT_DIR, 'patch-id', '--stable'],
+        stdin=revs.encode()
+    )
+    if cmd_ret['retcode'] != 0:
+        LOG.warning('Unable to compute patch-ids: %s', cmd_ret['stdout'])
+        return
+
+    rows = []
+    for line in cmd_ret['stdout'].decode().splitlines():
+        patch_id, commit = line.split()
+        rows.append((config.GIT_DIR, commit, patch_id))
+
+    try:
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO patch_ids (repo, commit_sha, patch_id) VALUES (?, ?, ?)',
+                rows
+            )
+            # Everything reachable from the current tips is indexed now
+            conn.execute('DELETE FROM indexed_tips WHERE repo = ?', (config.GIT_DIR,))
+            conn.executemany(
+                'INSERT INTO indexed_tips (repo, tip) VALUES (?, ?)',
+                [(config.GIT_DIR, tip) for tip in tips]
+            )
+    except sqlite3.Error as exc:
+        LOG.warning('Patch-id index update failed: %s', exc)
+
+
+def equivalent_commits(commit):
+    '''
+    Returns the list of indexed commits that make the same change as the
+    given commit, not including the commit itself.
+
+    commit
+        The full commit sha to find equivalents of.
+    '''
+    conn = cache.connect(config.PATCH_INDEX_PATH, _SCHEMA)
+    if conn is None:
+        return []
+
+    patch_id = get_patch_id(commit, conn=conn)
+    if patch_id is None:
+        return []
+
+    try:
+        rows = conn.execute(
+            'SELECT commit_sha FROM patch_ids WHERE repo = ? AND patch_id = ? AND commit_sha != ?',
+            (config.GIT_DIR, patch_id, commit)
+        ).fetchall()
+    except sqlite3.Error as exc:
+        LOG.warning('Patch-id index lookup failed: %s', exc)
+        return []
+    return sorted(row[0] for row in rows)
+
+
+def get_patch_id(commit, conn=None):
+    '''
+    Returns the patch-id of the given commit, or None if it has no diff.
+    Indexed commits are looked up; others are diffed.
+
+    commit
+        The full commit sha.
+
+    conn
+        An open connection to the index database, if any.
+    '''
+    if conn is not None:
+        try:
+            row = conn.execute(
+                'SELECT patch_id FROM patch_ids WHERE repo = ? AND commit_sha = ?',
+                (config.GIT_DIR, commit)
+            ).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row is not None:
+            return row[0]
+
+    cmd_ret = util.cmd_pipe(
+        ['git', config.GIT_DIR, 'show', commit] + _DIFF_ARGS,
+        ['git', config.GIT_DIR, 'patch-id', '--stable']
+    )
+    output = cmd_ret['stdout'].decode().split()
+    if cmd_ret['retcode'] != 0 or not output:
+        return None
+    return output[0]
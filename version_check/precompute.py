@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+'''
+Background precomputation of containment answers.
+
+Most searches are for pull requests that were merged recently, and the first
+search for each of them would otherwise pay for the containment scans across
+every branch and tag. After each fetch, the commits of the pull requests
+merged since the previous fetch are handed to a ``Precomputer``, which
+searches them one at a time in a background thread so that their answers are
+in the containment cache before anyone asks.
+
+The thread runs at a lower CPU priority where the platform allows it (the git
+commands it starts inherit that priority), and it pauses while any searches
+are queued or running, so that it only uses otherwise idle time.
+'''
+
+# Import Python libs
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+# Import version_check libs
+import version_check.config as config
+import version_check.metrics as metrics
+
+LOG = logging.getLogger(__name__)
+
+# Seconds to wait before checking again whether searches are still running
+_PAUSE = 0.1
+
+# Added to the thread's niceness
+_NICENESS = 10
+
+
+class Precomputer(object):
+    '''
+    Runs the given function for each submitted commit in a background thread.
+    Nothing runs until ``start`` is called, so that only long-running
+    processes spend time on answers that may be asked for later.
+
+    compute_func
+        The function that computes and caches the answers for a commit. It
+        is called with the full commit sha.
+    '''
+
+    def __init__(self, compute_func):
+        self._compute_func = compute_func
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.enabled = False
+
+    def start(self):
+        '''
+        Enables precomputation in this process.
+        '''
+        self.enabled = True
+
+    def submit(self, commits):
+        '''
+        Queues the given commits for precomputation. At most
+        ``config.PRECOMPUTE_MAX_COMMITS`` commits are kept queued; the oldest
+        are dropped first.
+
+        commits
+            The full shas of the commits.
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            for commit in commits:
+                self._pending.pop(commit, None)
+                self._pending[commit] = None
+            while len(self._pending) > config.PRECOMPUTE_MAX_COMMITS:
+                self._pending.popitem(last=False)
+            if not self._pending:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='precompute')
+                self._thread.daemon = True
+                self._thread.start()
+            self._wakeup.set()
+
+    def pending(self):
+        '''
+        Returns the number of commits waiting to be precomputed.
+        '''
+        with self._lock:
+            return len(self._pending)
+
+    def _run(self):
+        '''
+        Precomputes queued commits until the process exits.
+        '''
+        _lower_priority()
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                if not self._pending:
+                    self._wakeup.clear()
+                    continue
+                commit, _ = self._pending.popitem(last=False)
+
+            while _searches_active():
+                time.sleep(_PAUSE)
+            try:
+                with metrics.timer('precompute'):
+                    self._compute_func(commit)
+                metrics.inc('version_check_precomputed_commits_total')
+            except Exception:
+                LOG.exception('Unable to precompute the containment of %s.', commit)
+
+
+def _searches_active():
+    '''
+    Returns whether any searches are queued or running in this process.
+    '''
+    return (metrics.get('version_check_searches_queued') > 0 or
+            metrics.get('version_check_searches_running') > 0)
+
+
+def _lower_priority():
+    '''
+    Lowers the CPU priority of the calling thread. Only Linux sets priorities
+    per thread; elsewhere, this does nothing.
+    '''
+    if not sys.platform.startswith('linux') or not hasattr(threading, 'get_native_id'):
+        return
+    thread_id = threading.get_native_id()
+    try:
+        niceness = os.getpriority(os.PRIO_PROCESS, thread_id)
+        os.setpriority(os.PRIO_PROCESS, thread_id, niceness + _NICENESS)
+    except OSError:
+        pass
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+'''
+Index of pull request numbers to commit shas.
+
+The head (and merge) refs of every pull request are fetched from
+``config.REMOTE`` into a dedicated ref namespace, ``config.PR_NAMESPACE``,
+alongside the regular fetch. Git keeps those refs on disk and fetches them
+incrementally; this module keeps an in-memory map of pull request number to
+sha built from them, so a pull request lookup is a dictionary hit, and the
+inverted map of head sha to pull request number. The maps are rebuilt when the
+refs change, including when another process fetched them.
+'''
+
+# Import Python libs
+import os
+import threading
+
+# Import version_check libs
+import version_check.backend as backend
+import version_check.config as config
+import version_check.fetcher as fetcher
+
+_LOCK = threading.Lock()
+_INDEX = {}
+
+
+def refspecs(pr_num='*'):
+    '''
+    Returns the refspecs that fetch pull request refs into the index
+    namespace.
+
+    pr_num
+        The pull request number to fetch. Default: all pull requests.
+    '''
+    kinds = ['head', 'merge'] if config.PR_INDEX_MERGE_REFS else ['head']
+    return ['+refs/pull/{0}/{1}:{2}/{0}/{1}'.format(pr_num, kind, config.PR_NAMESPACE)
+            for kind in kinds]
+
+
+def lookup(pr_num, kind='head'):
+    '''
+    Returns the sha of the given pull request's head or merge ref, or None
+    if the pull request is not in the index.
+
+    pr_num
+        The number of the PR.
+
+    kind
+        The pull request ref to look up: ``head`` or ``merge``.
+    '''
+    return _current()[0].get((str(pr_num), kind))
+
+
+def heads():
+    '''
+    Returns the inverted index of pull request heads: a dictionary of the
+    sha of each pull request's head ref to the pull request number.
+    '''
+    return _current()[1]
+
+
+def fetch_one(pr_num):
+    '''
+    Fetches a single pull request's refs into the index namespace and adds
+    it to the index. Returns the ``util.cmd_run`` result of the fetch.
+
+    pr_num
+        The number of the PR.
+    '''
+    git_backend = backend.get()
+    cmd_ret = git_backend.run(fetcher.fetch_args(refspecs(pr_num=pr_num)))
+    if cmd_ret['retcode'] != 0 and config.PR_INDEX_MERGE_REFS:
+        # Closed pull requests have no merge ref; retry with the head only
+        cmd_ret = git_backend.run(fetcher.fetch_args(refspecs(pr_num=pr_num)[:1]))
+    if cmd_ret['retcode'] == 0:
+        refresh()
+    return cmd_ret
+
+
+def refresh():
+    '''
+    Rebuilds the in-memory index, and its inverted index of pull request
+    heads, from the refs in the index namespace and returns both.
+    '''
+    # Taken before reading the refs, so that a concurrent update is noticed
+    stamp = backend.refs_stamp(config.GIT_DIR)
+    prefix = config.PR_NAMESPACE + '/'
+    index = {}
+    pr_heads = {}
+    for ref, sha in backend.get().ref_tips(prefix).items():
+        pr_num, _, kind = ref[len(prefix):].partition('/')
+        index[(pr_num, kind)] = sha
+        if kind == 'head' and pr_num.isdigit():
+            pr_heads[sha] = int(pr_num)
+
+    with _LOCK:
+        _INDEX[config.GIT_DIR] = (stamp, index, pr_heads)
+    return index, pr_heads
+
+
+def _current():
+    '''
+    Returns the index and the inverted index of pull request heads, rebuilding
+    them first if the refs changed since they were built.
+    '''
+    stamp = backend.refs_stamp(config.GIT_DIR)
+    with _LOCK:
+        cached = _INDEX.get(config.GIT_DIR)
+    if cached is None or cached[0] != stamp:
+        return refresh()
+    return cached[1], cached[2]
+
+
+def _reset_after_fork():
+    '''
+    Give a forked child its own lock, in case another thread held the
+    parent's at the time of the fork.
+    '''
+    global _LOCK
+    _LOCK = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
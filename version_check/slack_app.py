@@ -36,9 +36,9 @@ To do so, the following settings should be established:
 4. Click "Create App"
 5. Under "Add features and functionality", choose "Slash Commands", then click
    "Create New Command"
-6. Fill out the related fields. This app presently accepts only one option, which
-   is the PR number to search for. This may be expanded in the future, but for now,
-   create your Slack App with this information in mind. Note also that this file
+6. Fill out the related fields. This app accepts the PR number or commit to search
+   for, or ``prs`` followed by a range such as ``v2018.3.2..v2018.3.3`` to list the
+   PRs merged in it. Note also that this file
    uses "/version-check" as the event endpoint to send the requests.
 7. Once the App is created, note the "Verification Token". That will be used later.
 8. Install the App in your Slack team.
@@ -71,27 +71,61 @@ Some settings can be changed in the ``config`` file in this repo, such as the
 location of the git clone, the port the server should run on (defaults to 8888),
 or the name of the git clone's remote.
 
-Git Clone & Cron Job
+Searches run on a pool of worker threads so they never block the server while
+git is working. ``SEARCH_CONCURRENCY`` in the ``config`` file sets how many
+searches may run at once; additional searches wait for a free worker. Identical
+searches that arrive together share a single search, and recent results are
+answered from memory until the repository's refs change.
+
+At most ``SLACK_QUEUE_SIZE`` commands that need a new search are accepted at
+a time; further commands are answered right away with a request to try again
+later, while commands that can be answered from memory are always accepted.
+Searches that take longer than ``SEARCH_TIMEOUT`` seconds, including the time
+spent waiting for a worker, are stopped and reported as errors.
+
+On a machine with several cores, set ``SEARCH_PROCESSES`` to run searches in
+that many worker processes instead. The worker processes are started with the
+server and take searches from a shared queue, while the server itself keeps
+validating and acknowledging Slack commands and posting the results.
+
+The server also serves its metrics at ``/metrics`` in the Prometheus text
+format: the time spent in each phase of a search, the git subprocesses run,
+where containment answers came from, how many searches are queued and in
+flight, and the latency of Slack commands from receipt to posted results.
+
+Git Clone & Fetching
 --------------------
 
-The final part is setting up a git clone of the selected repo and a management job
-of some kind configured to fetch upstream contributions, such as a cron job.
+The final part is setting up a git clone of the selected repo.
 
 .. note::
     The git repository should be cloned to the server running the tornado server
     _before_ starting the ``slack_app.py`` file.
 
-Once the repository is cloned, set up a management job to periodically pull down
-any new changes to the repo. This ensures the results of the version_check search
-are up-to-date.
+The server keeps the clone up-to-date itself by fetching from upstream in the
+background every ``FETCH_INTERVAL`` seconds (see the ``config`` file). Set
+``FETCH_INTERVAL`` to ``0`` to disable background fetches, for example when a
+cron job or other management job already fetches the clone. Fetches that are
+requested while another fetch is running share that fetch, and fetches
+requested within ``FETCH_DEBOUNCE`` seconds of the last one are skipped.
+
+After each fetch, the pull requests it brought in are searched in the
+background, at a low priority and only while no other searches are running, so
+that the first searches for newly merged pull requests are answered from the
+containment cache. ``PRECOMPUTE_MAX_COMMITS`` limits how many commits are
+precomputed after a fetch.
 '''
 
 # Import Python libs
+import asyncio
+import collections
+import functools
 import hashlib
 import hmac
 import logging
 import json
 import os
+import re
 import sys
 import time
 import urllib.parse
@@ -100,16 +134,37 @@ import urllib.parse
 from tornado import gen
 import tornado.ioloop
 import tornado.web
-import tornado.httpclient
 
 # Import Version Check libs
 import version_check.config as config
 import version_check.core as core
+import version_check.delivery as delivery
+import version_check.metrics as metrics
+import version_check.oidindex as oidindex
 
 SLACK_SIGNING_SECRET = os.environ.get('SLACK_SIGNING_SECRET')
 
 LOG = logging.getLogger(__name__)
 
+# Searches currently running, and recent search results, keyed by the
+# normalized search item.
+_IN_FLIGHT = {}
+_RESULTS = collections.OrderedDict()
+
+# Full or abbreviated commit shas
+_SHA_RE = re.compile(r'^[0-9a-fA-F]{{{0},40}}$'.format(oidindex.MIN_LENGTH))
+
+# Number of admitted commands that need a search and have not finished
+_ADMITTED = 0
+
+_BUSY_TEXT = 'Version Check is busy right now. Please try again in a minute.'
+
+# Commands starting with this list the pull requests merged in a range
+_LIST_PRS_COMMAND = 'prs '
+
+# Pull requests shown in the results of a ``prs`` command
+_MAX_LISTED_PRS = 200
+
 
 class EventHandler(tornado.web.RequestHandler):
     '''
@@ -124,34 +179,78 @@ class EventHandler(tornado.web.RequestHandler):
         if not _validate_slack_signature(self.request):
             raise tornado.web.HTTPError(401)
 
+        admitted = _admit(self.request)
+        if admitted is None:
+            # Shed load: tell the user right away instead of queueing
+            LOG.warning('Search queue is full. Asking the user to try again later.')
+            metrics.inc('version_check_slack_requests_total', answer='rejected')
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps({'response_type': 'ephemeral', 'text': _BUSY_TEXT}))
+            return
+
         # Do event work on the ioloop - this allows us to POST to Slack
         # later with search results, but respond/return to the original
         # request quickly to avoid `Timeout` errors in the Slack Client.
         tornado.ioloop.IOLoop.current().add_callback(
-            handle_event, self.request
+            handle_event, self.request, admitted
         )
         return
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+    '''
+    Handler for the ``/metrics`` endpoint, which serves the app's metrics in
+    the Prometheus text format.
+    '''
+
+    def data_received(self, chunk):
+        pass
+
+    def get(self, *args, **kwargs):
+        metrics.set_gauge('version_check_slack_in_flight_searches', len(_IN_FLIGHT))
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
+
+
 def make_app():
     '''
-    Create the tornado web application - uses the "events" endpoint.
+    Create the tornado web application - uses the "events" endpoint, and
+    serves metrics at ``/metrics``.
     '''
     return tornado.web.Application([
         ('/salt-version', EventHandler),
+        ('/metrics', MetricsHandler),
     ])
 
 
 @gen.coroutine
-def handle_event(request):
+def handle_event(request, admitted=False):
     '''
     Handle the event from Slack - find matches, if applicable, and send the
     POST response back to Slack.
 
     request
         The original request from Slack.
+
+    admitted
+        Whether the event holds a place in the search queue, which is given
+        up when the event has been handled.
+    '''
+    global _ADMITTED
+    try:
+        yield _handle_event(request)
+    finally:
+        if admitted:
+            _ADMITTED -= 1
+
+
+@gen.coroutine
+def _handle_event(request):
+    '''
+    Handle the event from Slack. See ``handle_event``.
     '''
     LOG.info('Received Version Check event from slack. Processing...')
+    start = time.perf_counter()
 
     params = urllib.parse.parse_qs(request.body.decode())
     url = params.get('response_url')[0]
@@ -160,7 +259,8 @@ def handle_event(request):
         search_item = params.get('text')[0]
     except TypeError:
         LOG.error('PR number or commit was not provided.')
-        post_data = {'attachments': [{'text': 'Please provide a pull request number or commit hash.',
+        post_data = {'attachments': [{'text': 'Please provide a pull request number or commit hash, '
+                                              'or "prs" and a range such as v2018.3.2..v2018.3.3.',
                                       'color': 'danger'}]}
         yield api_call(url, post_data)
         return
@@ -169,14 +269,20 @@ def handle_event(request):
     yield api_call(url, {'text': 'Searching...'})
 
     # Find matches; longer running job
-    yield get_matches(url, search_item)
+    kind, item = _parse_command(search_item)
+    if kind == 'prs':
+        yield get_pr_list(url, item)
+    else:
+        yield get_matches(url, search_item)
+    metrics.observe('version_check_slack_request_seconds', time.perf_counter() - start)
     return
 
 
 @gen.coroutine
 def api_call(url, post_data):
     '''
-    Send a POST request to Slack.
+    Send a POST request to Slack, retrying if it fails. See
+    ``version_check.delivery``.
 
     url
         The URL to send the api call to.
@@ -184,15 +290,7 @@ def api_call(url, post_data):
     post_data
         The data to send to Slack.
     '''
-    http_client = tornado.httpclient.AsyncHTTPClient()
-    request = tornado.httpclient.HTTPRequest(
-        url=url,
-        method='POST',
-        headers={'Content-Type': 'application/json'},
-        body=json.dumps(post_data).encode('utf-8')
-    )
-
-    yield http_client.fetch(request)
+    yield delivery.post(url, post_data)
     return
 
 
@@ -212,23 +310,31 @@ def get_matches(url, search_item):
     pr_num = None
     commit = None
 
-    try:
-        int(search_item)
-        pr_num = search_item.lstrip('#')
+    kind, item = _parse_command(search_item)
+    if kind == 'pr':
+        pr_num = item
         log_id = 'PR #{0}'.format(pr_num)
-    except ValueError:
-        # search_item is a commit hash; use the short SHA
-        commit = search_item[:7]
+    else:
+        # search_item is a commit hash; abbreviations are resolved by the search
+        commit = item
         log_id = 'Commit {0}'.format(commit)
-        pass
 
     LOG.info('%s: Searching for matches.', log_id)
 
-    # Find any branch or tag matches
-    matches = core.search(pr_num=pr_num, commit=commit)
+    # Find any branch or tag matches without blocking the IOLoop
+    matches = yield search(pr_num=pr_num, commit=commit)
+    attachment_title = '{0} Search Results:'.format(log_id)
+    if matches.get('error'):
+        LOG.error('%s: %s', log_id, matches['error'])
+        post_data['attachments'] = [{'title': attachment_title,
+                                     'text': matches['error'],
+                                     'color': 'danger'}]
+        yield api_call(url, post_data)
+        return
+
     branches = matches.get('branches')
     tags = matches.get('tags')
-    attachment_title = '{0} Search Results:'.format(log_id)
+    first_tags = matches.get('first_tags')
 
     # Configure matches in respective "fields"
     fields = []
@@ -238,6 +344,9 @@ def get_matches(url, search_item):
     if tags:
         tags = ", ".join(tags)
         fields.append({'title': 'Tags', 'value': tags})
+    if first_tags:
+        first_tags = ", ".join(sorted(first_tags.values(), key=lambda tag: core.parse_tag(tag)[1]))
+        fields.append({'title': 'First Released In', 'value': first_tags})
 
     if fields:
         # We have matches, format attachment fields
@@ -258,6 +367,222 @@ def get_matches(url, search_item):
     return
 
 
+@gen.coroutine
+def get_pr_list(url, rev_range):
+    '''
+    List the pull requests merged in the given range, then format them into
+    the correct post_data, and reply to Slack.
+
+    url
+        The URL to respond to.
+
+    rev_range
+        The range to list, such as ``v2018.3.2..v2018.3.3``, or a branch or
+        tag.
+    '''
+    LOG.info('Range %s: Listing pull requests.', rev_range)
+    ret = yield list_prs(rev_range)
+    attachment_title = 'Pull Requests in {0}:'.format(rev_range)
+    if ret.get('error'):
+        LOG.error('Range %s: %s', rev_range, ret['error'])
+        attachment = {'text': ret['error'], 'color': 'danger'}
+    elif ret['pull_requests']:
+        numbers = ['#{0}'.format(pull_request['number']) for pull_request in ret['pull_requests']]
+        text = ', '.join(numbers[:_MAX_LISTED_PRS])
+        if len(numbers) > _MAX_LISTED_PRS:
+            text += ' and {0} more'.format(len(numbers) - _MAX_LISTED_PRS)
+        LOG.info('Range %s: %d pull requests found.', rev_range, len(numbers))
+        attachment = {'text': text, 'color': 'good'}
+    else:
+        LOG.info('Range %s: No pull requests found.', rev_range)
+        attachment = {'text': 'No pull requests found.', 'color': 'warning'}
+    attachment['title'] = attachment_title
+
+    # Respond to Slack with results
+    yield api_call(url, {'attachments': [attachment]})
+    return
+
+
+@gen.coroutine
+def search(pr_num=None, commit=None):
+    '''
+    Search for the branches and tags that the PR or commit is included in.
+
+    Identical searches that arrive while one is already running share its
+    result instead of starting their own. Results are also kept in an
+    in-memory LRU cache of ``config.SLACK_RESULT_CACHE_SIZE`` entries for up
+    to ``config.SLACK_RESULT_CACHE_TTL`` seconds, and are discarded as soon
+    as the repository's refs change.
+
+    pr_num
+        The pull request number to search for.
+
+    commit
+        The commit to search for.
+    '''
+    key = _search_key(pr_num, commit)
+    result = yield _shared_search(key, functools.partial(core.search_async,
+                                                         pr_num=pr_num,
+                                                         commit=commit,
+                                                         timeout=config.SEARCH_TIMEOUT or None))
+    return result
+
+
+@gen.coroutine
+def list_prs(rev_range):
+    '''
+    List the pull requests merged in the given range. Like searches, listings
+    are shared and cached; see ``search``.
+
+    rev_range
+        The range to list.
+    '''
+    result = yield _shared_search(('prs', rev_range),
+                                  functools.partial(core.list_prs_async,
+                                                    rev_range,
+                                                    timeout=config.SEARCH_TIMEOUT or None))
+    return result
+
+
+@gen.coroutine
+def _shared_search(key, start):
+    '''
+    Returns the result of the search with the given key from the result
+    cache, or from the identical search already in flight, or else starts
+    the search by calling ``start`` and returns its result.
+    '''
+    stamp = core.refs_stamp()
+
+    result = _cached_result(key, stamp)
+    if result is not None:
+        _RESULTS.move_to_end(key)
+        metrics.inc('version_check_slack_requests_total', answer='cached')
+        return result
+
+    future = _IN_FLIGHT.get(key)
+    if future is None:
+        metrics.inc('version_check_slack_requests_total', answer='searched')
+        future = asyncio.ensure_future(start())
+        future.add_done_callback(functools.partial(_search_done, key, stamp))
+        _IN_FLIGHT[key] = future
+    else:
+        metrics.inc('version_check_slack_requests_total', answer='coalesced')
+
+    result = yield future
+    return result
+
+
+def _admit(request):
+    '''
+    Decides whether a command from Slack may be handled. Returns False for
+    commands that are answered without a new search (from the result cache,
+    or by sharing a search that is already running), True for commands that
+    take a place in the search queue, and None when the queue is full.
+
+    request
+        The request from Slack.
+    '''
+    global _ADMITTED
+    params = urllib.parse.parse_qs(request.body.decode())
+    kind, item = _parse_command((params.get('text') or [''])[0])
+    if kind == 'prs':
+        key = ('prs', item)
+    elif kind == 'pr':
+        key = _search_key(item, None)
+    else:
+        key = _search_key(None, item)
+    if key in _IN_FLIGHT or _cached_result(key, core.refs_stamp()) is not None:
+        return False
+
+    if _ADMITTED >= config.SLACK_QUEUE_SIZE:
+        return None
+    _ADMITTED += 1
+    return True
+
+
+def _parse_command(text):
+    '''
+    Returns the kind of the given slash command text, ``prs``, ``pr`` or
+    ``commit``, and the range, pull request number or commit it names. This
+    is the only place commands are parsed, so a command is admitted under the
+    same key it is searched with.
+
+    text
+        The text of the slash command.
+    '''
+    text = text.strip()
+    if text.startswith(_LIST_PRS_COMMAND):
+        return 'prs', text[len(_LIST_PRS_COMMAND):].strip()
+    if text.lstrip('#').isdigit():
+        return 'pr', text.lstrip('#')
+    return 'commit', text
+
+
+def _cached_result(key, stamp):
+    '''
+    Returns the cached result of the search with the given key, or None if
+    there is no result that is still valid for the given refs stamp.
+    '''
+    cached = _RESULTS.get(key)
+    if cached is None:
+        return None
+    cached_stamp, expires, result = cached
+    if cached_stamp != stamp or expires <= time.time():
+        del _RESULTS[key]
+        return None
+    return result
+
+
+def _search_key(pr_num, commit):
+    '''
+    Returns the key identifying a search: the pull request number, or the
+    full id of the object an abbreviated or full sha names when the object id
+    index finds exactly one. Other commits are keyed as given. The index is
+    cheap enough to check for every command, so the same key is used when
+    admitting a command and when searching.
+    '''
+    if pr_num:
+        return ('pr', int(pr_num))
+
+    if _SHA_RE.match(commit):
+        candidates = oidindex.lookup(commit)
+        if len(candidates) == 1:
+            return ('commit', candidates[0])
+        return ('commit', commit.lower())
+    return ('commit', commit)
+
+
+def _search_done(key, stamp, future):
+    '''
+    Remove a finished search from the in-flight searches and cache its result.
+    '''
+    _IN_FLIGHT.pop(key, None)
+    if future.cancelled() or future.exception() is not None:
+        return
+
+    result = future.result()
+    if result.get('error'):
+        return
+
+    _RESULTS[key] = (stamp, time.time() + config.SLACK_RESULT_CACHE_TTL, result)
+    _RESULTS.move_to_end(key)
+    while len(_RESULTS) > config.SLACK_RESULT_CACHE_SIZE:
+        _RESULTS.popitem(last=False)
+
+
+@gen.coroutine
+def fetch():
+    '''
+    Fetch the latest refs from upstream without blocking the IOLoop.
+    '''
+    cmd_ret = yield tornado.ioloop.IOLoop.current().run_in_executor(
+        None, core.fetch_remote
+    )
+    if cmd_ret is not None and cmd_ret['retcode'] != 0:
+        LOG.error('Background fetch failed: %s', cmd_ret['stdout'])
+    return
+
+
 def _validate_slack_signature(request):
     '''
     Validate that the request is coming from Slack.
@@ -337,8 +662,16 @@ if __name__ == '__main__':
         sys.exit()
 
     LOG.info('Starting Version Check server.')
+    if config.SEARCH_PROCESSES:
+        LOG.info('Starting %s search worker processes.', config.SEARCH_PROCESSES)
+        core.start_search_workers()
+    core.start_precompute()
     LOG.info('Listening on port \'%s\'.', config.SLACK_APP_PORT)
 
     APP = make_app()
     APP.listen(config.SLACK_APP_PORT)
+    if config.FETCH_INTERVAL:
+        LOG.info('Fetching from upstream every %s seconds.', config.FETCH_INTERVAL)
+        tornado.ioloop.IOLoop.current().add_callback(fetch)
+        tornado.ioloop.PeriodicCallback(fetch, config.FETCH_INTERVAL * 1000).start()
     tornado.ioloop.IOLoop.current().start()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+'''
+Generator for synthetic git repositories shaped like the Salt repository.
+
+The generated upstream repository has a ``develop`` branch into which pull
+requests are merged with "Merge pull request #N" merge commits, release
+branches forked from ``develop`` at regular intervals, annotated ``v`` release
+tags on those branches, and a ``refs/pull/N/head`` ref for every pull request.
+A clone of it is set up with ``origin`` pointing at it over ``file://``, so
+everything, including fetches, works without network access.
+
+Used by the benchmark and load-test tools.
+'''
+
+# Import Python libs
+import os
+import random
+import subprocess
+
+# Import version_check libs
+import version_check.util as util
+
+# Default shape of a generated repository
+SHAPE = {
+    'depth': 1000,
+    'release_lines': 5,
+    'tags_per_line': 5,
+    'pull_requests': 200,
+    'merge_density': 0.5,
+}
+
+# Every commit changes one of this many files, so trees stay the same size
+# however deep the history is
+_FILES = 32
+
+
+def make_repo(path, seed=0, **shape):
+    '''
+    Creates an upstream repository and a clone of it under the given path and
+    returns a dictionary describing them: the clone's ``git_dir`` argument
+    (suitable for ``config.GIT_DIR``), the ``upstream`` path, and the lists of
+    ``pull_requests`` numbers, ``branches`` and ``tags`` created.
+
+    path
+        The directory to create the repositories in.
+
+    seed
+        The seed for the random choices made while generating history.
+
+    shape
+        Overrides of the keys of ``SHAPE``: ``depth`` (number of commits on
+        ``develop``), ``release_lines``, ``tags_per_line``, ``pull_requests``
+        and ``merge_density`` (the fraction of ``develop`` commits that merge
+        a pull request).
+    '''
+    params = dict(SHAPE)
+    params.update(shape)
+    rand = random.Random(seed)
+
+    upstream = os.path.join(path, 'upstream.git')
+    clone = os.path.join(path, 'clone')
+    _git(['init', '--quiet', '--bare', upstream])
+    _git(['--git-dir=' + upstream, 'config', 'uploadpack.allowFilter', 'true'])
+
+    stream, ret = _history(params, rand)
+    cmd_ret = util.cmd_run(['git', '--git-dir=' + upstream, 'fast-import', '--quiet'],
+                           stdin=stream.encode())
+    if cmd_ret['retcode'] != 0:
+        raise RuntimeError('git fast-import failed: {0}'.format(cmd_ret['stdout']))
+    _git(['--git-dir=' + upstream, 'symbolic-ref', 'HEAD', 'refs/heads/develop'])
+
+    _git(['clone', '--quiet', '--no-checkout', 'file://' + upstream, clone])
+    ret['git_dir'] = '--git-dir=' + os.path.join(clone, '.git')
+    ret['upstream'] = upstream
+    return ret
+
+
+def _history(params, rand):
+    '''
+    Returns a ``git fast-import`` stream creating the repository's history,
+    and the description of what it contains.
+    '''
+    lines = []
+    marks = [0]
+    clock = [1500000000]
+
+    def commit(ref, message, parents):
+        marks[0] += 1
+        clock[0] += 60
+        lines.append('commit {0}'.format(ref))
+        lines.append('mark :{0}'.format(marks[0]))
+        lines.append('committer Synthetic <synthetic@example.com> {0} +0000'.format(clock[0]))
+        _data(lines, message)
+        if parents:
+            lines.append('from :{0}'.format(parents[0]))
+            for parent in parents[1:]:
+                lines.append('merge :{0}'.format(parent))
+        lines.append('M 644 inline file-{0}'.format(rand.randrange(_FILES)))
+        _data(lines, '{0}\n'.format(marks[0]))
+        return marks[0]
+
+    pull_requests = []
+    develop = []
+    tip = None
+    next_pr = 1000
+    for _ in range(params['depth']):
+        if len(pull_requests) < params['pull_requests'] and rand.random() < params['merge_density']:
+            feature = commit('refs/pull/{0}/head'.format(next_pr), 'Change {0}'.format(next_pr),
+                             [tip] if tip else [])
+            message = 'Merge pull request #{0} from contributor/change-{0}'.format(next_pr)
+            tip = commit('refs/heads/develop', message, [tip, feature] if tip else [feature])
+            pull_requests.append(next_pr)
+            next_pr += 1
+        else:
+            tip = commit('refs/heads/develop', 'Develop commit', [tip] if tip else [])
+        develop.append(tip)
+
+    branches = ['develop']
+    tags = []
+    line_count = params['release_lines']
+    for line in range(line_count):
+        name = '{0}.{1}'.format(2015 + line // 2, 7 if line % 2 else 3)
+        base = develop[(line + 1) * len(develop) // (line_count + 1) - 1]
+        branch_tip = base
+        for release in range(params['tags_per_line']):
+            for _ in range(rand.randint(1, 3)):
+                branch_tip = commit('refs/heads/' + name, 'Fix on ' + name, [branch_tip])
+            tag = 'v{0}.{1}'.format(name, release)
+            clock[0] += 60
+            lines.append('tag {0}'.format(tag))
+            lines.append('from :{0}'.format(branch_tip))
+            lines.append('tagger Synthetic <synthetic@example.com> {0} +0000'.format(clock[0]))
+            _data(lines, 'Release {0}\n'.format(tag))
+            tags.append(tag)
+        branches.append(name)
+
+    return '\n'.join(lines) + '\n', {'pull_requests': pull_requests,
+                                     'branches': branches,
+                                     'tags': tags}
+
+
+def _data(lines, text):
+    '''
+    Appends a ``data`` command with the given text to a fast-import stream.
+    '''
+    lines.append('data {0}'.format(len(text.encode())))
+    lines.append(text)
+
+
+def _git(args):
+    '''
+    Runs a git command, raising an error if it fails.
+    '''
+    subprocess.check_call(['git'] + args, stdout=subprocess.DEVNULL)
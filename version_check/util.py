@@ -4,23 +4,100 @@ Miscellaneous utility functions
 '''
 
 # Import Python libs
+import contextlib
+import os
+import select
+import signal
 import subprocess
+import threading
+import time
 
+# Import version_check libs
+import version_check.metrics as metrics
 
-def cmd_run(cmd_args):
+_DEADLINE = threading.local()
+
+# Bytes read from a command's output at a time by cmd_lines
+_READ_SIZE = 65536
+
+
+class CommandTimeout(Exception):
+    '''
+    Raised when a command is stopped because the deadline set with
+    ``deadline`` has passed.
+    '''
+
+
+class CommandError(Exception):
+    '''
+    Raised when a command fails, such as by ``cmd_lines``.
+    '''
+
+
+@contextlib.contextmanager
+def deadline(timeout):
+    '''
+    Context manager that sets a deadline for the commands run by this thread
+    with ``cmd_run``, ``cmd_pipe`` and ``cmd_lines``. Once the deadline
+    passes, the running command is killed, together with any processes it
+    started, and ``CommandTimeout`` is raised, as it is for any command
+    started afterwards. Nested deadlines can only shorten the current
+    deadline.
+
+    timeout
+        The number of seconds until the deadline. None sets no deadline.
+    '''
+    previous = getattr(_DEADLINE, 'at', None)
+    at = previous
+    if timeout is not None:
+        at = time.monotonic() + timeout
+        if previous is not None:
+            at = min(at, previous)
+    _DEADLINE.at = at
+    try:
+        yield
+    finally:
+        _DEADLINE.at = previous
+
+
+def remaining_time():
+    '''
+    Returns the number of seconds left until this thread's deadline, or None
+    if there is no deadline. Raises ``CommandTimeout`` if it has passed.
+    '''
+    at = getattr(_DEADLINE, 'at', None)
+    if at is None:
+        return None
+    remaining = at - time.monotonic()
+    if remaining <= 0:
+        raise CommandTimeout('The deadline has passed')
+    return remaining
+
+
+def cmd_run(cmd_args, stdin=None):
     '''
     Runs the given command in a subprocess and returns a dictionary containing
-    the subprocess pid, retcode, stdout, and stderr.
+    the subprocess pid, retcode, stdout, and stderr. The command and the
+    processes it started are killed, and ``CommandTimeout`` raised, if this
+    thread's deadline passes.
 
     cmd_args
         The list of program arguments constructing the command to run.
+
+    stdin
+        Bytes to send to the command's standard input. Default: no input.
     '''
     ret = {}
+    command = command_name(cmd_args)
+    timeout = remaining_time()
+    metrics.inc('version_check_subprocesses_total', command=command)
     try:
         proc = subprocess.Popen(
             cmd_args,
+            stdin=subprocess.PIPE if stdin is not None else None,
             stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
+            stderr=subprocess.STDOUT,
+            start_new_session=True
         )
     except (OSError, ValueError) as exc:
         ret['stdout'] = str(exc)
@@ -29,7 +106,219 @@ def cmd_run(cmd_args):
         ret['pid'] = None
         return ret
 
-    ret['stdout'], ret['stderr'] = proc.communicate()
+    try:
+        ret['stdout'], ret['stderr'] = proc.communicate(input=stdin, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_group(proc)
+        _close(proc)
+        metrics.inc('version_check_command_timeouts_total', command=command)
+        raise CommandTimeout('{0} did not finish in time and was stopped'.format(command))
+    except KeyboardInterrupt:
+        # The command runs in its own session, out of reach of the terminal
+        _kill_group(proc)
+        _close(proc)
+        raise
+    metrics.inc('version_check_subprocess_bytes_read_total', len(ret['stdout']), command=command)
     ret['pid'] = proc.pid
     ret['retcode'] = proc.returncode
     return ret
+
+
+def cmd_pipe(first_args, second_args, stdin=None):
+    '''
+    Runs the first command with its output piped into the second command, and
+    returns a dictionary containing the second subprocess' pid, stdout, and
+    stderr, and the retcode of whichever command failed (or 0). Both commands,
+    and the processes they started, are killed, and ``CommandTimeout``
+    raised, if this thread's deadline passes.
+
+    first_args
+        The list of program arguments constructing the first command.
+
+    second_args
+        The list of program arguments constructing the second command.
+
+    stdin
+        Bytes to send to the first command's standard input. Default: no input.
+    '''
+    ret = {}
+    command = command_name(first_args)
+    timeout = remaining_time()
+    metrics.inc('version_check_subprocesses_total', command=command)
+    metrics.inc('version_check_subprocesses_total', command=command_name(second_args))
+    try:
+        first = subprocess.Popen(
+            first_args,
+            stdin=subprocess.PIPE if stdin is not None else None,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True
+        )
+        second = subprocess.Popen(
+            second_args,
+            stdin=first.stdout,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True
+        )
+    except (OSError, ValueError) as exc:
+        ret['stdout'] = str(exc)
+        ret['stderr'] = ''
+        ret['retcode'] = 1
+        ret['pid'] = None
+        return ret
+
+    # The second command owns the pipe now
+    first.stdout.close()
+
+    writer = None
+    if stdin is not None:
+        def _write():
+            try:
+                first.stdin.write(stdin)
+                first.stdin.close()
+            except (IOError, OSError):
+                pass
+        writer = threading.Thread(target=_write)
+        writer.start()
+
+    try:
+        ret['stdout'], ret['stderr'] = second.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_group(first)
+        _kill_group(second)
+        _close(second)
+        _close(first)
+        if writer is not None:
+            writer.join()
+        metrics.inc('version_check_command_timeouts_total', command=command)
+        raise CommandTimeout('{0} did not finish in time and was stopped'.format(command))
+    except KeyboardInterrupt:
+        # The commands run in their own sessions, out of reach of the terminal
+        _kill_group(first)
+        _kill_group(second)
+        _close(second)
+        _close(first)
+        raise
+    metrics.inc('version_check_subprocess_bytes_read_total', len(ret['stdout']), command=command)
+    first.wait()
+    if writer is not None:
+        writer.join()
+    ret['pid'] = second.pid
+    ret['retcode'] = first.returncode or second.returncode
+    return ret
+
+
+def cmd_lines(cmd_args):
+    '''
+    Runs the given command in a subprocess and yields the lines of its
+    output, without line endings, as the command writes them. Raises
+    ``CommandError`` with the command's error output if it fails. The command
+    and the processes it started are killed, and ``CommandTimeout`` raised,
+    as soon as this thread's deadline passes, without waiting for the end of
+    their output. They are killed as well if the caller stops reading early.
+
+    cmd_args
+        The list of program arguments constructing the command to run.
+    '''
+    command = command_name(cmd_args)
+    timeout = remaining_time()
+    metrics.inc('version_check_subprocesses_total', command=command)
+    try:
+        proc = subprocess.Popen(
+            cmd_args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True
+        )
+    except (OSError, ValueError) as exc:
+        raise CommandError(str(exc))
+
+    at = None if timeout is None else time.monotonic() + timeout
+    stdout_fd = proc.stdout.fileno()
+    timed_out = False
+    finished = False
+    bytes_read = 0
+    stderr = b''
+    try:
+        pending = b''
+        while True:
+            if at is not None:
+                # Wait for output only until the deadline
+                wait = at - time.monotonic()
+                if wait <= 0 or not select.select([stdout_fd], [], [], wait)[0]:
+                    timed_out = True
+                    break
+            chunk = os.read(stdout_fd, _READ_SIZE)
+            if not chunk:
+                finished = True
+                break
+            bytes_read += len(chunk)
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        if pending and finished:
+            yield pending
+    finally:
+        if finished:
+            stderr = proc.stderr.read()
+        else:
+            # Timed out, or the caller stopped reading early
+            _kill_group(proc)
+        _close(proc)
+        metrics.inc('version_check_subprocess_bytes_read_total', bytes_read, command=command)
+
+    if timed_out:
+        metrics.inc('version_check_command_timeouts_total', command=command)
+        raise CommandTimeout('{0} did not finish in time and was stopped'.format(command))
+    if proc.returncode != 0:
+        raise CommandError(stderr.decode(errors='replace').strip())
+
+
+def _kill_group(proc):
+    '''
+    Kills the command and the processes it started, which share its process
+    group. Where process groups are not available, only the command itself is
+    killed.
+    '''
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+
+def _close(proc):
+    '''
+    Waits for a killed command to exit and closes its pipes, without reading
+    the rest of its output: processes that escaped the kill may hold the
+    pipes open indefinitely.
+    '''
+    proc.wait()
+    for pipe in (proc.stdin, proc.stdout, proc.stderr):
+        if pipe is not None:
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+
+
+def command_name(cmd_args):
+    '''
+    Returns a short name for the given command, used to label its metrics:
+    the subcommand for git commands (e.g. ``git fetch``), and the program
+    name otherwise.
+
+    cmd_args
+        The list of program arguments constructing the command.
+    '''
+    if not cmd_args:
+        return ''
+    if cmd_args[0] == 'git':
+        for arg in cmd_args[1:]:
+            if not arg.startswith('-'):
+                return 'git ' + arg
+    return cmd_args[0]